@@ -4,15 +4,171 @@ import time
 import os
 from cohost.models.user import User
 from cohost.models.block import AttachmentBlock, MarkdownBlock
+from cohost.network import fetch, generate_login_cookies
 import sys
 import json
 import sched
+import random
+from jwst_chost_bundle import ChostBundle, entries_from_chosts
 
 username = ""
 password = ""
 handle = ""
 
-def post_chost(chost, base_dir):
+# cohost sessions are long-lived, log in again a little before one would run out
+session_max_age = 7 * 24 * 60 * 60
+session_refresh_margin = 60 * 60
+
+# drafts (and their screenshots) are uploaded this many seconds before the post time, so only the
+# publish call is left when it's time to post
+stage_lead_time = 10 * 60
+
+# posts whose post time passed less than this many seconds ago (e.g. while the Pi was rebooting) still go out
+catch_up_window = 15 * 60
+
+# failed uploads and publishes are tried again after post_retry_delay seconds, doubling every time up to
+# post_retry_max_delay, and the post is given up on after post_retry_attempts tries
+post_retry_attempts = 6
+post_retry_delay = 30
+post_retry_max_delay = 15 * 60
+
+journal_file_name = "post_journal.jsonl"
+
+# posted and failed posts are kept in the journal for this many seconds after they were finished, long enough
+# that a chosts file still listing them (or listing a posted visit at a new time) doesn't get them posted again
+journal_retention = 14 * 24 * 60 * 60
+
+# how often (in seconds) the link file and the chosts it points to are checked for changes
+watch_interval = 30
+
+def is_auth_error(e):
+    message = str(e).lower()
+    return any(word in message for word in ["unauthorized", "unauthenticated", "not logged in", "401", "403"])
+
+def post_data(chost, block_data, draft):
+    return {
+        "postState": 0 if draft else 1,
+        "headline": chost["title"],
+        "adultContent": False,
+        "blocks": block_data,
+        "cws": [],
+        "tags": chost["tags"],
+    }
+
+def check_put_response(res):
+    # cohost.py's fetch doesn't raise on failed PUTs
+    if "postId" not in res:
+        raise Exception(res)
+
+class CohostApi:
+    # The cohost calls the bot makes. Posts go out in two steps, like cohost.py's project.post does
+    # internally: first a draft with the attachments uploaded, then a PUT that publishes it. The draft's
+    # blocks (with the attachment ids) are returned, so the publish can be repeated from the journal.
+    # Passing the `post_id` of an earlier draft overwrites that draft instead of creating a new one.
+    def login(self, username, password, handle):
+        user = User.login(username, password)
+        project = user.getProject(handle)
+        if project is None:
+            raise Exception(f"the account can't post to @{handle}")
+        return project
+
+    def create_draft(self, project, chost, blocks, post_id = None):
+        cookies = generate_login_cookies(project.user.cookie)
+        if post_id is None:
+            res = fetch("postJSON", f"/project/{project.handle}/posts", post_data(chost, [block.dict for block in blocks], draft = True), cookies)
+            post_id = res["postId"]
+
+        for block in blocks:
+            if isinstance(block, AttachmentBlock):
+                block.uploadIfNot(post_id, project)
+        block_data = [block.dict for block in blocks]
+        check_put_response(fetch("put", f"/project/{project.handle}/posts/{post_id}", post_data(chost, block_data, draft = True), cookies))
+
+        return (post_id, block_data)
+
+    def publish(self, project, post_id, chost, block_data):
+        # a PUT of the whole post, so doing it twice doesn't post twice
+        cookies = generate_login_cookies(project.user.cookie)
+        check_put_response(fetch("put", f"/project/{project.handle}/posts/{post_id}", post_data(chost, block_data, draft = False), cookies))
+
+class StubProject:
+    def __init__(self, handle):
+        self.handle = handle
+        self.logged_in_at = time.time()
+
+class StubApi:
+    # Stands in for CohostApi to try the bot offline (--stub). Nothing leaves the machine, every call
+    # takes `latency` seconds, and sessions stop working after `session_lifetime` seconds.
+    def __init__(self, latency = 0.2, session_lifetime = 60 * 60):
+        self.latency = latency
+        self.session_lifetime = session_lifetime
+        self.next_post_id = 1
+        self.logins = 0
+
+    def check_session(self, project):
+        time.sleep(self.latency)
+        if time.time() - project.logged_in_at > self.session_lifetime:
+            raise Exception({"error": "unauthorized", "message": "not logged in"})
+
+    def login(self, username, password, handle):
+        time.sleep(self.latency)
+        self.logins += 1
+        return StubProject(handle)
+
+    def create_draft(self, project, chost, blocks, post_id = None):
+        self.check_session(project)
+        for block in blocks:
+            if isinstance(block, AttachmentBlock):
+                time.sleep(self.latency)
+        if post_id is not None:
+            print(f"[stub] overwrote draft {post_id} with '{chost['title']}' on @{project.handle}")
+            return (post_id, [block.dict for block in blocks])
+        post_id = self.next_post_id
+        self.next_post_id += 1
+        print(f"[stub] created draft {post_id} '{chost['title']}' on @{project.handle}")
+        return (post_id, [block.dict for block in blocks])
+
+    def publish(self, project, post_id, chost, block_data):
+        self.check_session(project)
+        print(f"[stub] published post {post_id} '{chost['title']}'")
+
+class Session:
+    # Logs in once and keeps the project around. Logs in again only when cohost rejects the session
+    # or it's about to expire, so a post normally doesn't cost any login round trips.
+    def __init__(self, api, username, password, handle):
+        self.api = api
+        self.username = username
+        self.password = password
+        self.handle = handle
+        self.project = None
+        self.logged_in_at = None
+
+    def login(self):
+        start = time.perf_counter()
+        self.project = self.api.login(self.username, self.password, self.handle)
+        self.logged_in_at = time.time()
+        return time.perf_counter() - start
+
+    def call(self, action, *args):
+        # runs `action(project, *args)`, returns (result, seconds spent logging in, seconds spent in the call)
+        auth_seconds = 0
+        if self.project is None or time.time() - self.logged_in_at > session_max_age - session_refresh_margin:
+            auth_seconds += self.login()
+
+        start = time.perf_counter()
+        try:
+            result = action(self.project, *args)
+        except Exception as e:
+            if not is_auth_error(e):
+                raise
+            print("session was rejected, logging in again")
+            auth_seconds += self.login()
+            start = time.perf_counter()
+            result = action(self.project, *args)
+
+        return (result, auth_seconds, time.perf_counter() - start)
+
+def make_blocks(chost, base_dir):
     blocks = []
 
     for block in chost["body"]:
@@ -22,65 +178,400 @@ def post_chost(chost, base_dir):
             case "image":
                 blocks.append(AttachmentBlock(os.path.join(base_dir, f"screenshots/{block['value']}"), alt_text = block["alt_text"]))
 
-    user = User.login(username, password)
-    project = user.getProject(handle)
+    return blocks
 
-    # change draft to False once it's ready
-    print(f"posting chost '{chost['title']}'")
-    newPost = project.post(chost["title"], blocks, tags = chost["tags"], draft=False)
+def post_key(entry):
+    return f"{entry.name} {entry.post_time}"
 
-if __name__ == "__main__":
-    print("\n\nSTARTING NEW SESSION")
-    print(datetime.now())
-    print("\n\n\n")
-    if len(sys.argv) != 3:
-        print(f"""Usage: python {sys.argv[0]} [creds file] [link file] -- the link file is a simple text file that contains the path to the current base dir
-when uploading the next chosts json, simply put the path to the new folder into this file and the program
-will read it and load the new files once it has completed posting the old chosts.""")
-        exit(1)
+def post_names(entries):
+    # identifies the chosts across reloads independent of their post time, so a moved post is rescheduled
+    # instead of posted twice. A visit that's in the schedule more than once gets a counter.
+    names = {}
+    for entry in entries:
+        name = entry.name
+        if name in names:
+            n = 2
+            while f"{name} #{n}" in names:
+                n += 1
+            name = f"{name} #{n}"
+        names[name] = entry
+    return names
 
-    with open(sys.argv[1]) as f:
-        creds = json.load(f)
-        username = creds["username"]
-        password = creds["password"]
-        handle = creds["handle"]
+def parse_post_time(post_time):
+    return datetime.strptime(post_time, "%Y-%m-%d %H:%M:%S %Z").replace(tzinfo=pytz.utc).timestamp()
 
-    link_file = sys.argv[2]
+def load_entries(base_dir):
+    # prefers chosts.bundle, which only has to be read up to its index, over chosts.json, unless chosts.json was
+    # edited after the bundle was written
+    bundle_file = os.path.join(base_dir, "chosts.bundle")
+    chosts_file = os.path.join(base_dir, "chosts.json")
+    if os.path.isfile(bundle_file) and (not os.path.isfile(chosts_file) or os.path.getmtime(bundle_file) >= os.path.getmtime(chosts_file)):
+        return (bundle_file, ChostBundle(bundle_file).entries)
 
-    base_dir = ""
+    with open(chosts_file, 'r') as f:
+        return (chosts_file, entries_from_chosts(json.load(f)))
 
-    s = sched.scheduler(time.time, time.sleep)
+class PostJournal:
+    # Append-only log of every post's state (pending, staged, posted or failed), one JSON line per change.
+    # Lines are only flushed, not synced, to go easy on the SD card; a torn last line after a power cut is
+    # skipped when the journal is read back, which at worst means a step is done again.
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.file = None
+
+        lines = 0
+        broken = 0
+        torn = False
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    torn = not line.endswith("\n")
+                    if line.strip() == "":
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        print(f"skipping a broken line in {path}")
+                        broken += 1
+                        continue
+                    self.entries.setdefault(record["key"], {}).update(record)
+                    lines += 1
+
+        # also gets rid of broken lines, so they're only reported once
+        if broken > 0 or lines > 4 * len(self.entries) + 100 or any(self.expired(entry) for entry in self.entries.values()):
+            self.compact()
+            torn = False
+
+        self.file = open(path, 'a')
+        if torn:
+            # make sure a torn last line doesn't swallow the next record
+            self.file.write("\n")
+            self.file.flush()
+
+    def expired(self, entry):
+        return entry.get("state") in ("posted", "failed") and entry["time"] < time.time() - journal_retention
+
+    def compact(self):
+        # rewrites the journal with only the latest state of every post, leaving out the ones that were finished
+        # more than journal_retention ago
+        self.entries = {key: entry for (key, entry) in self.entries.items() if not self.expired(entry)}
+        tmp_path = self.path + ".part"
+        with open(tmp_path, 'w') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps({k: v for (k, v) in entry.items() if v is not None}) + "\n")
+        os.replace(tmp_path, self.path)
+
+        if self.file is not None:
+            # still points at the old file
+            self.file.close()
+            self.file = open(self.path, 'a')
+
+    def get(self, key):
+        return self.entries.get(key, {})
+
+    def find_posted(self, name):
+        # a post of the chost called `name` (see post_names) at any post time
+        for entry in self.entries.values():
+            if entry.get("state") == "posted" and entry.get("name") == name:
+                return entry
+        return None
+
+    def record(self, key, state, **fields):
+        if state in ("posted", "failed"):
+            # the uploaded blocks are only needed to publish, a finished post just has to be recognized
+            fields["blocks"] = None
+        record = {"key": key, "state": state, "time": time.time(), **fields}
+        self.entries.setdefault(key, {}).update(record)
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+def retry_delay(attempt):
+    # exponential backoff with jitter, so retries after an outage don't all land at the same moment
+    delay = min(post_retry_max_delay, post_retry_delay * 2 ** (attempt - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+class ScheduledPost:
+    # The chost itself is only read from its bundle right before it's uploaded (see PostQueue.load),
+    # until then a post is just its index entry
+    def __init__(self, entry, base_dir, post_time, journal_entry):
+        self.entry = entry
+        self.chost = None
+        self.base_dir = base_dir
+        self.post_time = post_time
+        self.key = post_key(entry)
+        # picks up where the journal left off
+        self.post_id = journal_entry.get("post_id")
+        self.block_data = journal_entry.get("blocks")
+        self.attempts = journal_entry.get("attempts", 0)
+        self.stage_attempts = 0
+        self.auth_seconds = 0
+        self.upload_seconds = 0
+        self.events = []
 
+    @property
+    def title(self):
+        return self.chost["title"] if self.chost is not None else self.entry.name
 
-    had_current_chost = True
-    while had_current_chost:
+class PostQueue:
+    # Schedules the staging and publishing of every post, retries what failed and writes every step to the journal.
+    # `posts` holds the posts that are still to go out by their name (see post_names).
+    def __init__(self, scheduler, session, journal):
+        self.scheduler = scheduler
+        self.session = session
+        self.journal = journal
+        self.posts = {}
 
-        with open(link_file, 'r') as f:
-            base_dir = f.readline().replace('\n', '')
+    def enter(self, post, when, priority, action):
+        post.events.append(self.scheduler.enterabs(when, priority, action, argument = (post,)))
 
-        had_current_chost = False
+    def cancel(self, post):
+        for event in post.events:
+            try:
+                self.scheduler.cancel(event)
+            except ValueError:
+                # already ran
+                pass
+        post.events = []
 
-        chosts = None
-        with open(os.path.join(base_dir, "chosts.json"), 'r') as f:
-            chosts = json.load(f)
+    def sync(self, entries, base_dir, replaces_all):
+        # brings the scheduled posts in line with `entries` without touching the ones that didn't change. Posts that
+        # aren't in `entries` are cancelled if `replaces_all` is set, otherwise only the ones from the first new post time on.
+        names = post_names(entries)
+        first_post_time = min(parse_post_time(entry.post_time) for entry in entries)
 
-        assert(len(chosts) > 0)
+        for (name, post) in list(self.posts.items()):
+            if name not in names and (replaces_all or post.post_time >= first_post_time):
+                print(f"unscheduling chost '{post.title}'")
+                self.cancel(post)
+                del self.posts[name]
 
-        for chost in chosts:
-            # determine post time
-            post_time_stamp = datetime.strptime(chost["post_time"], "%Y-%m-%d %H:%M:%S %Z").replace(tzinfo=pytz.utc).timestamp()
+        for (name, entry) in names.items():
+            post = self.posts.get(name)
+            if post is not None:
+                if post.entry.crc == entry.crc and post.entry.post_time == entry.post_time:
+                    # might have moved within the bundle though
+                    post.entry = entry
+                    continue
+                print(f"chost '{post.title}' changed, rescheduling it")
+                self.cancel(post)
+                del self.posts[name]
 
-            if post_time_stamp < time.time():
-                # we already missed the slot. continue
-                continue
+                if post.entry.crc == entry.crc and post.block_data is not None and not self.journal.get(post_key(entry)):
+                    # only the post time moved, the uploaded draft can still be used
+                    self.journal.record(post_key(entry), "staged", name = name, post_time = entry.post_time, post_id = post.post_id, blocks = post.block_data, crc = entry.crc)
 
-            had_current_chost = True
+            self.schedule(name, entry, base_dir, parse_post_time(entry.post_time))
 
-            print(f"scheduling chost '{chost['title']}'")
-            s.enterabs(post_time_stamp, 0, post_chost, argument = (chost, base_dir))
+    def schedule(self, name, entry, base_dir, post_time):
+        key = post_key(entry)
+        journal_entry = self.journal.get(key)
 
-        if not had_current_chost:
+        match journal_entry.get("state"):
+            case "posted" | "failed":
+                return
+
+        posted = self.journal.find_posted(name)
+        if posted is not None:
+            # moved after it went out, e.g. in a fixed chosts.json or the next week's schedule
+            print(f"'{entry.name}' was already posted for {posted.get('post_time')}, not posting it again at {entry.post_time}")
+            return
+
+        if post_time < time.time() - catch_up_window:
+            print(f"missed the post time of '{entry.name}'")
+            self.journal.record(key, "failed", error = "missed the post time")
+            return
+
+        if not journal_entry:
+            self.journal.record(key, "pending", name = name, post_time = entry.post_time)
+        elif journal_entry.get("blocks") is not None and journal_entry.get("crc") != entry.crc:
+            # the chost changed after its draft was uploaded, the draft gets overwritten with the new content
+            print(f"'{entry.name}' changed since draft {journal_entry['post_id']} was uploaded, uploading it again")
+            self.journal.record(key, "pending", blocks = None, crc = None)
+
+        post = ScheduledPost(entry, base_dir, post_time, self.journal.get(key))
+        print(f"scheduling chost '{post.title}'" + (f" (draft {post.post_id} is already uploaded)" if post.block_data is not None else ""))
+        if post.block_data is None:
+            # publishing goes first when both fall on the same moment
+            self.enter(post, max(time.time(), post_time - stage_lead_time), 1, self.stage)
+        self.enter(post, max(time.time(), post_time), 0, self.publish)
+        self.posts[name] = post
+
+    def load(self, post):
+        if post.chost is None:
+            post.chost = post.entry.load()
+
+    def upload(self, post):
+        self.load(post)
+        blocks = make_blocks(post.chost, post.base_dir)
+        ((post.post_id, post.block_data), auth_seconds, upload_seconds) = self.session.call(self.session.api.create_draft, post.chost, blocks, post.post_id)
+        post.auth_seconds += auth_seconds
+        post.upload_seconds += upload_seconds
+        self.journal.record(post.key, "staged", title = post.title, post_id = post.post_id, blocks = post.block_data, crc = post.entry.crc)
+
+    def stage(self, post):
+        # uploads the draft ahead of time, if that keeps failing publish tries again at the post time
+        if post.block_data is not None:
+            return
+
+        try:
+            self.upload(post)
+        except Exception as e:
+            post.stage_attempts += 1
+            delay = retry_delay(post.stage_attempts)
+            print(f"couldn't stage '{post.title}': {e}")
+            if time.time() + delay < post.post_time:
+                self.enter(post, time.time() + delay, 1, self.stage)
+            return
+
+        print(f"staged '{post.title}' as draft {post.post_id} ({post.upload_seconds:.2f} s), publishing at {datetime.fromtimestamp(post.post_time)}")
+
+    def publish(self, post):
+        try:
+            if post.block_data is None:
+                print(f"'{post.title}' wasn't staged, uploading it now")
+                self.upload(post)
+            self.load(post)
+            (_, auth_seconds, publish_seconds) = self.session.call(self.session.api.publish, post.post_id, post.chost, post.block_data)
+        except Exception as e:
+            post.attempts += 1
+            if post.attempts >= post_retry_attempts:
+                print(f"giving up on '{post.title}' after {post.attempts} tries: {e}")
+                self.journal.record(post.key, "failed", attempts = post.attempts, error = str(e))
+                self.done(post)
+                return
+
+            delay = retry_delay(post.attempts)
+            print(f"couldn't post '{post.title}' ({e}), trying again in {delay:.0f} s")
+            self.journal.record(post.key, "pending" if post.block_data is None else "staged", attempts = post.attempts, error = str(e))
+            self.enter(post, time.time() + delay, 0, self.publish)
+            return
+
+        drift = time.time() - post.post_time
+        self.journal.record(post.key, "posted", post_id = post.post_id, drift = drift)
+
+        print(f"posted '{post.title}' (post {post.post_id}): auth {post.auth_seconds + auth_seconds:.2f} s, upload {post.upload_seconds:.2f} s, publish {publish_seconds:.2f} s, {drift:+.2f} s off the post time")
+        self.done(post)
+
+    def done(self, post):
+        post.chost = None
+        for (name, other) in list(self.posts.items()):
+            if other is post:
+                del self.posts[name]
+
+class ChostWatcher:
+    # Polls the link file and the chosts.bundle (or chosts.json) it points to every `watch_interval` seconds and syncs
+    # the queue whenever either changed, so a new week (or a fixed chosts.json) is picked up without a restart.
+    def __init__(self, link_file, scheduler, queue):
+        self.link_file = link_file
+        self.scheduler = scheduler
+        self.queue = queue
+        self.base_dir = None
+        self.stamps = None
+        self.waiting = False
+
+    def file_stamps(self, base_dir):
+        stamps = []
+        for path in [self.link_file, os.path.join(base_dir, "chosts.bundle"), os.path.join(base_dir, "chosts.json")]:
+            if os.path.isfile(path):
+                stat = os.stat(path)
+                stamps.append((path, stat.st_mtime_ns, stat.st_size))
+        return stamps
+
+    def check(self):
+        self.scheduler.enter(watch_interval, 2, self.check)
+        self.reload()
+
+        # says so once, then keeps watching for the next week's chosts
+        if not self.queue.posts and not self.waiting:
             print("Ran out of chosts :(")
-            exit(1)
+        self.waiting = not self.queue.posts
+
+    def reload(self):
+        try:
+            with open(self.link_file, 'r') as f:
+                base_dir = f.readline().replace('\n', '')
+            stamps = self.file_stamps(base_dir)
+            if base_dir == self.base_dir and stamps == self.stamps:
+                return
+
+            (chosts_file, entries) = load_entries(base_dir)
+            assert(len(entries) > 0)
+        except Exception as e:
+            # e.g. the chosts are still being copied over, try again next time
+            print(f"couldn't load the chosts from {self.link_file}: {e}")
+            return
+
+        if self.base_dir is not None:
+            print(f"reloading the chosts from {chosts_file}")
+        if self.base_dir is not None and base_dir != self.base_dir:
+            # a new week, a good moment to forget the posts that are long done
+            self.queue.journal.compact()
+
+        self.queue.sync(entries, base_dir, replaces_all = base_dir == self.base_dir)
+        (self.base_dir, self.stamps) = (base_dir, stamps)
+
+def take_option(args, name, default, convert = str):
+    # removes `name value` from args and returns the converted value
+    if name not in args:
+        return default
+
+    i = args.index(name)
+    if i + 1 >= len(args):
+        show_help()
+        exit(1)
+
+    value = convert(args[i + 1])
+    del args[i:i + 2]
+    return value
+
+def take_flag(args, name):
+    # removes `name` from args and returns whether it was present
+    if name not in args:
+        return False
+
+    args.remove(name)
+    return True
+
+def show_help():
+    print(f"""Usage: python {sys.argv[0]} [creds file] [link file] [--stub] [--lead SECONDS] [--catch-up SECONDS] [--journal FILE] [--watch-interval SECONDS] -- the link file is a simple text file that contains the path to the current base dir
+when uploading the next chosts json, simply put the path to the new folder into this file and the program
+will pick it up within {watch_interval} seconds. Changes to the current chosts.json are picked up the same way.
+--stub posts to a local stand-in for cohost instead, to try things out offline.
+--lead uploads every post's draft this many seconds ahead of its post time (default: {stage_lead_time}).
+--catch-up still posts chosts whose post time passed at most this many seconds ago, e.g. after a reboot (default: {catch_up_window}).
+--journal is where the state of every post is kept (default: {journal_file_name} next to the link file).""")
+
+if __name__ == "__main__":
+    print("\n\nSTARTING NEW SESSION")
+    print(datetime.now())
+    print("\n\n\n")
+
+    stub = take_flag(sys.argv, "--stub")
+    stage_lead_time = take_option(sys.argv, "--lead", stage_lead_time, float)
+    catch_up_window = take_option(sys.argv, "--catch-up", catch_up_window, float)
+    journal_file = take_option(sys.argv, "--journal", None)
+    watch_interval = take_option(sys.argv, "--watch-interval", watch_interval, float)
+
+    if len(sys.argv) != 3:
+        show_help()
+        exit(1)
+
+    with open(sys.argv[1]) as f:
+        creds = json.load(f)
+        username = creds["username"]
+        password = creds["password"]
+        handle = creds["handle"]
+
+    session = Session(StubApi() if stub else CohostApi(), username, password, handle)
+
+    link_file = sys.argv[2]
+    journal = PostJournal(journal_file or os.path.join(os.path.dirname(os.path.abspath(link_file)), journal_file_name))
+
+    s = sched.scheduler(time.time, time.sleep)
+    queue = PostQueue(s, session, journal)
+    watcher = ChostWatcher(link_file, s, queue)
 
-        s.run()
+    # the watcher reschedules itself, so this runs until the process is stopped
+    watcher.check()
+    s.run()
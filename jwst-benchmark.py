@@ -0,0 +1,419 @@
+import sys
+import os
+import time
+import random
+import csv
+import tempfile
+import importlib.util
+import io
+import json
+import datetime
+import platform
+import statistics
+
+# the parser's file name isn't a valid module name, so load it by path
+parser_spec = importlib.util.spec_from_file_location("jwst_observation_parser", os.path.join(os.path.dirname(os.path.abspath(__file__)), "jwst-observation-parser.py"))
+parser = importlib.util.module_from_spec(parser_spec)
+sys.modules["jwst_observation_parser"] = parser
+parser_spec.loader.exec_module(parser)
+
+schedule_widths = [
+    ("VISIT ID", 18),
+    ("PCS MODE", 10),
+    ("VISIT TYPE", 24),
+    ("SCHEDULED START TIME", 24),
+    ("DURATION", 16),
+    ("SCIENCE INSTRUMENT AND MODE", 44),
+    ("TARGET NAME", 26),
+    ("CATEGORY", 18),
+    ("KEYWORDS", 40),
+]
+
+instrument_modes = [
+    "NIRCam Imaging",
+    "NIRCam Wide Field Slitless Spectroscopy",
+    "NIRSpec IFU Spectroscopy",
+    "NIRSpec MultiObject Spectroscopy",
+    "MIRI Imaging",
+    "MIRI Medium Resolution Spectroscopy",
+    "NIRISS Single-Object Slitless Spectroscopy",
+]
+
+def schedule_row(values):
+    # a value running into the next column would shift everything after it
+    for (value, (name, width)) in zip(values, schedule_widths):
+        if len(value) >= width:
+            raise ValueError(f"`{value}` doesn't fit the {name} column")
+    return "".join(value.ljust(width) for (value, (_, width)) in zip(values, schedule_widths)).rstrip() + "\n"
+
+def make_schedule_lines(rows, seed = 0, proposals = 120):
+    # Header and fixed-width rows in the same layout as the STScI weekly schedules, including
+    # attached parallels, extra target rows without a VISIT ID and calibration visits.
+    rng = random.Random(seed)
+    proposal_ids = rng.sample(range(1000, 9000), proposals)
+
+    lines = [
+        "JWST Science Observing Schedule (synthetic)\n",
+        "\n",
+        "".join(name.ljust(width) for (name, width) in schedule_widths) + "  \n",
+        "-" * sum(width for (_, width) in schedule_widths) + "\n",
+    ]
+
+    minutes = 0
+    for _ in range(rows):
+        proposal = rng.choice(proposal_ids)
+        observation = rng.randint(1, 30)
+        (days, rest) = divmod(minutes, 24 * 60)
+        start = f"2024-{1 + days // 28 % 12:02d}-{1 + days % 28:02d}T{rest // 60:02d}:{rest % 60:02d}:{rng.randint(0, 59):02d}Z"
+        category = "Calibration" if rng.random() < 0.08 else rng.choice(["GO", "GTO", "DD"])
+        lines.append(schedule_row([
+            f"{proposal}:{observation}:{rng.randint(1, 5)}",
+            "FINEGUIDE",
+            "PRIME TARGETED FIXED",
+            start,
+            f"00/{rng.randint(0, 9):02d}:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d}",
+            rng.choice(instrument_modes),
+            f"TARGET-{proposal}-{observation}",
+            category,
+            "Galaxies, Star formation",
+        ]))
+
+        roll = rng.random()
+        if roll < 0.25:
+            lines.append(schedule_row(["", "", "PARALLEL PURE", "^ATTACHED TO PRIME^", "", rng.choice(instrument_modes), "", "", ""]))
+        elif roll < 0.30:
+            lines.append(schedule_row(["", "", "", "", "", "", f"TARGET-{proposal}-{observation}-B", "", ""]))
+
+        minutes += rng.randint(10, 240)
+
+    return lines
+
+def time_it(fn, repeat = 3):
+    # best of `repeat` runs
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def bench_layout(rows):
+    lines = make_schedule_lines(rows)
+    cats = parser.get_categories(lines)
+    layout = parser.ScheduleLayout(cats)
+    data_lines = lines[parser.first_obs_line - 1:]
+
+    def old():
+        for i in range(parser.first_obs_line, len(lines) + 1):
+            parser.parse_line(lines, i, cats)
+
+    def new():
+        for line in data_lines:
+            layout.parse(line)
+
+    old_seconds = time_it(old)
+    new_seconds = time_it(new)
+
+    print(f"{len(data_lines)} schedule rows")
+    print(f"  parse_line:           {old_seconds:.3f} s ({len(data_lines) / old_seconds:,.0f} rows/s)")
+    print(f"  ScheduleLayout.parse: {new_seconds:.3f} s ({len(data_lines) / new_seconds:,.0f} rows/s)")
+    print(f"  speedup: {old_seconds / new_seconds:.2f}x")
+
+def target_position(target):
+    # RA and Dec in degrees, spread over the whole sky
+    return (target * 11.5 % 360, (target * 37.25 % 180) - 90)
+
+def sexagesimal(value, places):
+    (whole, rest) = divmod(round(abs(value) * 3600 * 10 ** places), 3600 * 10 ** places)
+    (minutes, rest) = divmod(rest, 60 * 10 ** places)
+    return f"{whole:02d} {minutes:02d} {rest / 10 ** places:.{places}f}"
+
+def make_proposal_data(proposal_id, observations = 30):
+    # what parse_proposal_file returns for a proposal covering observations 1..observations
+    return {
+        "title": f"Synthetic proposal {proposal_id}",
+        "investigators": [(f"Principal Investigator {proposal_id}", "Some University"), ("Co Investigator", "Another University")],
+        "abstract": "A synthetic abstract. " * 20,
+        "observations": {o: (o, f"TARGET-{o}") for o in range(1, observations + 1)},
+        "targets": {o: (f"TARGET-{o}", tuple(f"{value:+.7f}d" for value in target_position(o))) for o in range(1, observations + 1)},
+    }
+
+class ScanIndex:
+    # stands in for ObservationIndex the way the enrichment worked before: a full scan per lookup
+    def __init__(self, observations):
+        self.observations = observations
+
+    def proposal(self, proposal_id):
+        return [obs for obs in self.observations if obs.proposal == proposal_id]
+
+    def visit(self, visit_id):
+        return [obs for obs in self.observations if obs.visit_id == visit_id]
+
+def bench_merge(weeks):
+    # a year of merged weekly schedules by default
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        schedule_file = os.path.join(tmp_dir, "archive.txt")
+        with open(schedule_file, 'w') as file:
+            file.writelines(make_schedule_lines(weeks * 700, proposals = weeks * 30))
+        observations = parser.parse_observations(schedule_file)
+
+        proposals = {pid: make_proposal_data(pid) for pid in set(obs.proposal for obs in observations)}
+
+        csv_file = os.path.join(tmp_dir, "archive.manual.csv")
+        with open(csv_file, 'w') as file:
+            writer = csv.writer(file)
+            writer.writerow(["Proposal", "Observation", "Num", "Link", "RA", "Dec", "PI", "PI Institution", "Title", "Abstract"])
+            for obs in observations[::10]:
+                writer.writerow([obs.proposal, obs.observation, obs.visit, "", "10.0 deg", "20.0 deg", "PI", "Institution", "Title", "Abstract"])
+
+        def merge(index):
+            for (vid, proposal) in proposals.items():
+                parser.apply_proposal_data(vid, proposal, index)
+            parser.insert_manual_csv_data(index, csv_file)
+
+        scan_seconds = time_it(lambda: merge(ScanIndex(observations)), repeat = 1)
+        index_seconds = time_it(lambda: merge(parser.ObservationIndex(observations)))
+
+    print(f"{len(observations)} observations, {len(proposals)} proposals, {len(observations[::10])} manual CSV rows")
+    print(f"  full scans:       {scan_seconds:.3f} s")
+    print(f"  ObservationIndex: {index_seconds:.3f} s (including building the index)")
+    print(f"  speedup: {scan_seconds / index_seconds:.1f}x")
+
+def bench_schedule(rows):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        schedule_file = os.path.join(tmp_dir, "schedule.txt")
+        with open(schedule_file, 'w') as file:
+            file.writelines(make_schedule_lines(rows))
+
+        observations = parser.parse_observations(schedule_file)
+        if any(not obs.target_name.startswith("TARGET-") for obs in observations):
+            print("the synthetic schedule doesn't parse into the right columns anymore")
+            exit(1)
+
+        return time_it(lambda: parser.parse_observations(schedule_file), repeat = 5)
+
+def pdf_string(text):
+    return "(" + text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") + ")"
+
+def make_pdf(pages):
+    # A minimal PDF with one Courier text block per page, one line of `pages[i]` per text line.
+    # Good enough for pypdf's layout extraction, which is all the parser looks at.
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None, # the page tree, once the page objects are known
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Courier >>",
+    ]
+    page_refs = []
+    for lines in pages:
+        stream = "BT /F1 8 Tf 12 TL 30 750 Td " + " ".join(f"{pdf_string(line)} Tj T*" for line in lines) + " ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream".encode("latin-1"))
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>".encode())
+        page_refs.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(page_refs)}] /Count {len(page_refs)} >>".encode()
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for (i, obj) in enumerate(objects):
+        offsets.append(len(out))
+        out += f"{i + 1} 0 obj\n".encode() + obj + b"\nendobj\n"
+
+    xref_offset = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for offset in offsets:
+        out += f"{offset:010d} 00000 n \n".encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode()
+    return bytes(out)
+
+def paginate(header, lines, per_page = 55):
+    # every page starts with the section header and ends with the page number, like the STScI PDFs
+    return [[header, ""] + lines[i:i + per_page] for i in range(0, max(len(lines), 1), per_page)]
+
+def make_proposal_pdf(proposal_id, pages, seed = 0):
+    # Overview pages (title, INVESTIGATORS, OBSERVATIONS, ABSTRACT), targets pages and then observation
+    # detail pages up to `pages` pages. Bigger proposals get more observations and targets.
+    rng = random.Random(seed)
+    observations = 4 + pages
+    targets = max(1, observations // 3)
+
+    overview = [
+        f"A synthetic survey of the {rng.choice(['dusty', 'distant', 'cold', 'young'])} universe",
+        f"around target field number {proposal_id}",
+        "Cycle: 3      Allocation: 42.0 hours",
+        "",
+        "INVESTIGATORS",
+        "Name".ljust(40) + "Institution",
+    ]
+    for i in range(2 + pages // 20):
+        role = "(PI)" if i == 0 else "(CoI)"
+        overview.append(f"Dr. Investigator{i} Synthetic {role}".ljust(40) + f"University of Somewhere {i}, Department of Astronomy")
+    overview += [
+        "",
+        "OBSERVATIONS",
+        "Folder".ljust(11) + "Observation".ljust(13) + "Label".ljust(14) + "Observing Template".ljust(26) + "Science Target",
+        "Main Folder",
+    ]
+    for o in range(1, observations + 1):
+        target = (o - 1) % targets + 1
+        overview.append(" " * 11 + str(o).ljust(13) + f"Obs{o}".ljust(14) + rng.choice(instrument_modes)[:24].ljust(26) + f"({target}) TARGET-{target}")
+    overview += ["", "ABSTRACT"]
+    overview += [f"Synthetic abstract line {i} of proposal {proposal_id}, standing in for the real thing." for i in range(12)]
+    overview += ["", "OBSERVING DESCRIPTION", "Observations are scheduled in a single visit per target."]
+
+    target_lines = []
+    for t in range(1, targets + 1):
+        # the way the STScI target pages write them, e.g. "RA: 12 36 52.7520 (189.2198000d)"
+        (ra, dec) = target_position(t)
+        target_lines.append(f"({t})".ljust(8) + f"TARGET-{t}".ljust(24) + f"RA: {sexagesimal(ra / 15, 4)} ({ra:.7f}d)")
+        target_lines.append(" " * 32 + f"Dec: {'-' if dec < 0 else '+'}{sexagesimal(dec, 2)} ({dec:+.7f}d)")
+
+    pdf_pages = paginate(f"JWST Proposal {proposal_id} (Created: 2024-01-01) - Overview", overview)
+    # an even page size keeps every RA line on the same page as its Dec line
+    pdf_pages += paginate(f"Proposal {proposal_id} - Targets - Synthetic", target_lines, per_page = 54)
+    pdf_pages = pdf_pages[:pages]
+    while len(pdf_pages) < pages:
+        pdf_pages += paginate(f"Proposal {proposal_id} - Observations", [f"Observation details, page {len(pdf_pages) + 1}"] * 40)
+
+    for (i, page) in enumerate(pdf_pages):
+        page.append(str(i + 1))
+
+    return make_pdf(pdf_pages)
+
+def bench_proposal(pages):
+    data = make_proposal_pdf(4242, pages)
+
+    def parse():
+        with parser.PdfReader(io.BytesIO(data)) as reader:
+            return parser.proposal_parse(parser.ProposalPages(reader.pages), 4242)
+
+    proposal = parse()
+    if proposal["title"] is None or (pages > 1 and len(proposal["targets"]) == 0):
+        print(f"the synthetic {pages}-page proposal doesn't parse anymore")
+        exit(1)
+    for (t, (_, (ra, dec))) in proposal["targets"].items():
+        if max(abs(a - b) for (a, b) in zip((parser.parse_ra(ra), parser.parse_dec(dec)), target_position(t))) > 1e-6:
+            print(f"target {t} of the synthetic {pages}-page proposal comes out at RA `{ra}` Dec `{dec}`")
+            exit(1)
+
+    return time_it(parse, repeat = 5)
+
+def make_enriched_observations(rows):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        schedule_file = os.path.join(tmp_dir, "schedule.txt")
+        with open(schedule_file, 'w') as file:
+            file.writelines(make_schedule_lines(rows))
+        observations = parser.parse_observations(schedule_file)
+
+    index = parser.ObservationIndex(observations)
+    for pid in set(obs.proposal for obs in observations):
+        parser.apply_proposal_data(pid, make_proposal_data(pid), index)
+    return observations
+
+def bench_output(rows):
+    observations = make_enriched_observations(rows)
+    metadata = parser.make_metadata_dict(observations)
+    return {
+        "make_metadata_dict": time_it(lambda: parser.make_metadata_dict(observations), repeat = 5),
+        "make_chosts": time_it(lambda: parser.make_chosts(metadata), repeat = 5),
+    }
+
+suite_schedule_rows = 20_000
+suite_proposal_pages = [1, 10, 50, 200]
+suite_output_rows = 5_000
+
+def run_suite():
+    results = dict()
+    results[f"parse_observations[{suite_schedule_rows}]"] = bench_schedule(suite_schedule_rows)
+    for pages in suite_proposal_pages:
+        results[f"proposal_parse[{pages}p]"] = bench_proposal(pages)
+    for (name, seconds) in bench_output(suite_output_rows).items():
+        results[f"{name}[{suite_output_rows}]"] = seconds
+    return results
+
+def load_history(history_file):
+    if not os.path.isfile(history_file):
+        return []
+    with open(history_file, 'r') as file:
+        return [json.loads(line) for line in file if line.strip() != ""]
+
+def bench_suite(history_file, max_regression, window, record):
+    # Compares every result against the median of the last `window` recorded runs, so a single
+    # noisy run in the history doesn't move the baseline much.
+    history = load_history(history_file)[-window:]
+    results = run_suite()
+
+    regressions = []
+    print(f"{'Benchmark'.ljust(32)}  {'Time [s]':>9}  {'Baseline [s]':>12}  {'Change':>8}")
+    for (name, seconds) in results.items():
+        previous = [run["results"][name] for run in history if name in run["results"]]
+        if len(previous) == 0:
+            print(f"{name.ljust(32)}  {seconds:>9.4f}  {'-':>12}  {'-':>8}")
+            continue
+
+        baseline = statistics.median(previous)
+        change = (seconds - baseline) / baseline * 100
+        print(f"{name.ljust(32)}  {seconds:>9.4f}  {baseline:>12.4f}  {change:>+7.1f}%")
+        if change > max_regression:
+            regressions.append(name)
+
+    if record:
+        with open(history_file, 'a') as file:
+            file.write(json.dumps({
+                "time": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec = "seconds"),
+                "python": platform.python_version(),
+                "results": results,
+            }) + "\n")
+
+    if len(regressions) > 0:
+        print(f"\n{len(regressions)} benchmark(s) regressed by more than {max_regression}%: {', '.join(regressions)}")
+        exit(1)
+
+def show_help():
+    print(f"""Usage: python {sys.argv[0]} [benchmark] [args...]
+
+        Benchmarks:
+            layout [rows]           - Compares parse_line with ScheduleLayout on a synthetic schedule (default: 100000 rows)
+            merge [weeks]           - Merges proposal and manual CSV data into an archive of weekly schedules, full scans vs. ObservationIndex (default: 52 weeks)
+            schedule [rows]         - parse_observations on a synthetic schedule (default: 20000 rows)
+            proposal [pages]        - proposal_parse on a generated proposal PDF (default: 1, 10, 50 and 200 pages)
+            output [rows]           - make_metadata_dict and make_chosts for an enriched synthetic schedule (default: 5000 rows)
+            suite                   - Runs schedule, proposal and output, records the results and fails on regressions
+            help                    - Displays this help page
+
+        Options (suite):
+            --history <FILE>        - File the results are appended to and compared against (default: benchmark-history.jsonl)
+            --max-regression <PCT>  - Exit with status 1 if a benchmark got slower than this many percent (default: 20)
+            --window <N>            - Compare against the median of the last N recorded runs (default: 5)
+            --no-record             - Only compare, don't append this run to the history
+        """)
+
+if __name__ == '__main__':
+    history_file = parser.take_option(sys.argv, "--history", "benchmark-history.jsonl")
+    max_regression = parser.take_option(sys.argv, "--max-regression", 20, float)
+    window = parser.take_option(sys.argv, "--window", 5, int)
+    record = not parser.take_flag(sys.argv, "--no-record")
+
+    if len(sys.argv) == 1:
+        show_help()
+        exit(1)
+
+    match sys.argv[1]:
+        case "layout":
+            bench_layout(int(sys.argv[2]) if len(sys.argv) > 2 else 100_000)
+        case "merge":
+            bench_merge(int(sys.argv[2]) if len(sys.argv) > 2 else 52)
+        case "schedule":
+            rows = int(sys.argv[2]) if len(sys.argv) > 2 else suite_schedule_rows
+            seconds = bench_schedule(rows)
+            print(f"parse_observations: {rows} rows in {seconds:.3f} s ({rows / seconds:,.0f} rows/s)")
+        case "proposal":
+            for pages in ([int(sys.argv[2])] if len(sys.argv) > 2 else suite_proposal_pages):
+                print(f"proposal_parse: {pages} page(s) in {bench_proposal(pages):.4f} s")
+        case "output":
+            rows = int(sys.argv[2]) if len(sys.argv) > 2 else suite_output_rows
+            for (name, seconds) in bench_output(rows).items():
+                print(f"{name}: {rows} rows in {seconds:.3f} s")
+        case "suite":
+            bench_suite(history_file, max_regression, window, record)
+        case _:
+            show_help()
@@ -4,14 +4,185 @@ import functools
 import subprocess
 import datetime
 import os
-import urllib.request
-from pypdf import PdfReader
+import time
+import io
+import hashlib
+import multiprocessing
+import urllib.parse
+import http.client
+import threading
+import tempfile
+import shutil
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from pypdf import PdfReader, PageObject
+from pypdf.generic import NameObject
 import csv
+import glob
+import contextlib
+import jwst_chost_bundle
+import cProfile
+import pstats
+import tracemalloc
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+try:
+    from PIL import Image, PngImagePlugin
+except ImportError:
+    # only needed to post-process the screenshots
+    Image = None
 
 categories_line = 3
 first_obs_line = 5
 
 stellarium_exe = "C:\\Program Files\\Stellarium\\stellarium.exe"
+stellarium_shards = 1
+stellarium_retries = 2
+stellarium_fov = 40
+stellarium_projection = "ProjectionFisheye"
+
+# Screenshots are scaled down to fit `screenshot_max_size` pixels (0 keeps the size) and reduced to a
+# palette of `screenshot_colors` colors (0 keeps full color and only optimises the compression)
+screenshot_max_size = 1280
+screenshot_colors = 256
+
+# "stellarium" or "builtin" (jwst_sky_renderer.py, needs NumPy but no Stellarium install or display)
+screenshot_renderer = "stellarium"
+
+# Visits whose targets round to the same position (in degrees) and whose start times fall into the
+# same bucket (in seconds) share one screenshot. Bump the render version whenever the script changes
+# what a screenshot looks like, so older screenshots aren't reused anymore.
+screenshot_position_step = 0.01
+screenshot_time_bucket = 10 * 60
+screenshot_render_version = 1
+
+class Profiler:
+    # Collects wall time, CPU time (including worker processes) and memory peaks per stage for
+    # --profile. While disabled, `stage` does nothing but run the stage.
+    def __init__(self):
+        self.enabled = False
+        self.cprofile_stage = None
+        self.cprofile = None
+        self.slowest = 10
+        self.stages = []
+        self.proposals = []
+        self.extra = dict()
+        # cProfile stats sent back by the parse workers, merged into the dump of `cprofile_stage`
+        self.worker_cprofile_stats = []
+
+    def enable(self, cprofile_stage = None, slowest = 10):
+        self.enabled = True
+        self.cprofile_stage = cprofile_stage
+        self.slowest = slowest
+        tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        if name == self.cprofile_stage:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+        tracemalloc.reset_peak()
+        cpu_start = process_cpu_seconds()
+        wall_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = process_cpu_seconds() - cpu_start
+            if name == self.cprofile_stage:
+                self.cprofile.disable()
+
+            self.stages.append({
+                "stage": name,
+                "wall_seconds": wall,
+                "cpu_seconds": cpu,
+                "tracemalloc_peak_bytes": tracemalloc.get_traced_memory()[1],
+                "peak_rss_bytes": peak_rss_bytes(),
+            })
+
+    def profiling(self, name):
+        # whether stage `name` is cProfiled, for stages whose work runs in worker processes
+        return self.enabled and self.cprofile_stage == name
+
+    def add_worker_cprofile_stats(self, stats):
+        self.worker_cprofile_stats.append(stats)
+
+    def record_proposal(self, vid, proposal):
+        if self.enabled:
+            self.proposals.append({"proposal": vid, "seconds": proposal["seconds"], "pages_extracted": proposal["extractions"]})
+
+    def record(self, key, value):
+        if self.enabled:
+            self.extra[key] = value
+
+    def write_report(self, report_file, command):
+        slowest = sorted(self.proposals, key = lambda p: p["seconds"], reverse = True)[:self.slowest]
+        report = {
+            "command": command,
+            "stages": self.stages,
+            "slowest_proposals": slowest,
+        }
+        report.update(self.extra)
+
+        with open(report_file, 'w') as file:
+            json.dump(report, file, indent = 2)
+
+        print(f"\n{'Stage'.ljust(16)}  {'Wall [s]':>9}  {'CPU [s]':>9}  {'tracemalloc peak':>16}")
+        for stage in self.stages:
+            print(f"{stage['stage'].ljust(16)}  {stage['wall_seconds']:>9.3f}  {stage['cpu_seconds']:>9.3f}  {stage['tracemalloc_peak_bytes'] / 1e6:>13.1f} MB")
+        for p in slowest:
+            print(f"  proposal #{p['proposal']}: {p['seconds']:.3f} s ({p['pages_extracted']} page(s) extracted)")
+        print(f"Profile report: {report_file}")
+
+        if self.cprofile is not None:
+            cprofile_file = f"{os.path.splitext(report_file)[0]}.{self.cprofile_stage}.prof"
+            stats = pstats.Stats(self.cprofile)
+            for worker_stats in self.worker_cprofile_stats:
+                stats.add(WorkerCProfileStats(worker_stats))
+            stats.dump_stats(cprofile_file)
+            print(f"cProfile dump of stage `{self.cprofile_stage}` ({len(self.worker_cprofile_stats)} worker call(s) merged in): {cprofile_file}")
+
+class WorkerCProfileStats:
+    # The stats dict of a cProfile.Profile from a worker process, in the shape pstats.Stats.add takes
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+def init_worker_process(*initializer):
+    # Forked workers inherit --profile's tracemalloc tracing and cProfile hook from the parent, which slows
+    # them down several times over, so only the parent is traced. Runs `initializer` (function, args...) after.
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+    sys.setprofile(None)
+    if len(initializer) > 0:
+        initializer[0](*initializer[1:])
+
+def process_cpu_seconds():
+    # user + system time of this process and of its finished children (the parse and output pools)
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+def peak_rss_bytes():
+    if resource is None:
+        return None
+
+    # ru_maxrss is in kilobytes on Linux but in bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale,
+    }
+
+profiler = Profiler()
 
 def get_line(lines, line_num):
     return lines[line_num - 1]
@@ -60,6 +231,191 @@ def parse_line(lines, line_num, cats):
 
     return data
 
+# schedule column name -> (ScheduleRow attribute, converter)
+schedule_columns = {
+    'VISIT ID': ('visit_id', None),
+    'PCS MODE': ('pcs_mode', None),
+    'VISIT TYPE': ('visit_type', lambda v: {v}),
+    'SCHEDULED START TIME': ('scheduled_start_time', None),
+    'DURATION': ('duration', None),
+    'SCIENCE INSTRUMENT AND MODE': ('science_instrument_and_mode', lambda v: {v}),
+    'TARGET NAME': ('target_name', None),
+    'CATEGORY': ('category', None),
+    'KEYWORDS': ('keywords', None),
+}
+
+class ScheduleRow:
+    __slots__ = tuple(attr for (attr, _) in schedule_columns.values())
+
+    def __init__(self, visit_id, pcs_mode, visit_type, scheduled_start_time, duration, science_instrument_and_mode, target_name, category, keywords):
+        self.visit_id = visit_id
+        self.pcs_mode = pcs_mode
+        self.visit_type = visit_type
+        self.scheduled_start_time = scheduled_start_time
+        self.duration = duration
+        self.science_instrument_and_mode = science_instrument_and_mode
+        self.target_name = target_name
+        self.category = category
+        self.keywords = keywords
+
+    def to_dict(self):
+        return {name: getattr(self, attr) for (name, (attr, _)) in schedule_columns.items()}
+
+class ScheduleLayout:
+    # Column slices and converters worked out once from the header line, so that parsing a row doesn't
+    # need any per-column lookups or matching on the column names.
+    def __init__(self, cats):
+        spans = {cat_name: slice(cat_start, cat_end) for (cat_name, cat_start, cat_end) in cats}
+        # columns missing from the header come out as empty strings
+        self.columns = tuple((spans.get(name, slice(0, 0)), convert) for (name, (_, convert)) in schedule_columns.items())
+
+    def parse(self, line):
+        values = []
+        for (span, convert) in self.columns:
+            value = line[span].strip()
+            values.append(value if convert is None else convert(value))
+        return ScheduleRow(*values)
+
+# .auto.json key -> Observation attribute for everything filled in after the schedule was parsed
+observation_fields = {
+    'title': 'title',
+    'pi name': 'pi_name',
+    'pi institution': 'pi_institution',
+    'abstract': 'abstract',
+    'co-investigators': 'co_investigators',
+    'ra': 'ra',
+    'dec': 'dec',
+    'screenshot': 'screenshot',
+}
+
+coordinate_separators = str.maketrans({c: " " for c in "hdms:°'\"′″"})
+
+def parse_angle(value, hours):
+    # Decimal degrees ("23.4567 deg", "23.4567", and "189.2198000d" as on the STScI target pages) or
+    # sexagesimal with spaces, colons or units ("01 33 50.89", "01:33:50.89", "01h33m50.89s", "+30d39m36.8s").
+    # Sexagesimal RA is in hours, as is a single number with an explicit "h".
+    if isinstance(value, (int, float)):
+        return float(value)
+    if value is None:
+        raise ValueError(value)
+
+    text = value.strip().lower().replace("−", "-")
+    if text.endswith("deg"):
+        return float(text[:-3])
+
+    fields = text.translate(coordinate_separators).split()
+    if len(fields) == 1 and text.rstrip("d°").strip() == fields[0]:
+        return float(fields[0])
+    if not 1 <= len(fields) <= 3:
+        raise ValueError(value)
+
+    numbers = [float(field) for field in fields]
+    if any(not 0 <= n < 60 for n in numbers[1:]):
+        raise ValueError(value)
+
+    degrees = abs(numbers[0]) + sum(n / 60 ** i for (i, n) in enumerate(numbers[1:], 1))
+    if text.startswith("-"):
+        degrees = -degrees
+    return degrees * 15 if hours else degrees
+
+def parse_ra(value):
+    try:
+        ra = parse_angle(value, hours = True)
+    except ValueError:
+        raise ValueError(f"can't read RA `{value}`")
+    if not 0 <= ra < 360:
+        raise ValueError(f"RA `{value}` is outside of 0..360 degrees (0h..24h)")
+    return ra
+
+def parse_dec(value):
+    try:
+        dec = parse_angle(value, hours = False)
+    except ValueError:
+        raise ValueError(f"can't read Dec `{value}`")
+    if not -90 <= dec <= 90:
+        raise ValueError(f"Dec `{value}` is outside of -90..+90 degrees")
+    return dec
+
+def format_ra(degrees):
+    # e.g. "01h33m50.890s"
+    (hours, rest) = divmod(round(degrees / 15 * 3600 * 1000), 3600 * 1000)
+    (minutes, rest) = divmod(rest, 60 * 1000)
+    return f"{hours % 24:02d}h{minutes:02d}m{rest / 1000:06.3f}s"
+
+def format_dec(degrees):
+    # e.g. "+30d39m36.80s"
+    (whole, rest) = divmod(round(abs(degrees) * 3600 * 100), 3600 * 100)
+    (minutes, rest) = divmod(rest, 60 * 100)
+    return f"{'-' if degrees < 0 else '+'}{whole:02d}d{minutes:02d}m{rest / 100:05.2f}s"
+
+class Observation(ScheduleRow):
+    # A schedule row with its VISIT ID, start time and duration parsed once at ingest, plus the data
+    # filled in from the proposal PDFs and CSV files. Unknown values are None.
+    __slots__ = ('proposal', 'observation', 'visit', 'start', 'duration_seconds') + tuple(observation_fields.values())
+
+    def __init__(self, *values):
+        super().__init__(*values)
+
+        (self.proposal, self.observation, self.visit) = map(int, self.visit_id.split(":"))
+        self.start = datetime.datetime.fromisoformat(self.scheduled_start_time.replace("Z", "+00:00"))
+        (days, hms) = self.duration.split("/")
+        (hours, minutes, seconds) = map(int, hms.split(":"))
+        self.duration_seconds = ((int(days) * 24 + hours) * 60 + minutes) * 60 + seconds
+
+        for attr in observation_fields.values():
+            setattr(self, attr, None)
+
+    @staticmethod
+    def from_row(row):
+        return Observation(*(getattr(row, attr) for attr in ScheduleRow.__slots__))
+
+    @staticmethod
+    def from_json(data, problems = None):
+        # Coordinates that can't be used are added to `problems` as (observation, message) if given
+        obs = Observation(*(data[name] for name in schedule_columns))
+        for (key, attr) in observation_fields.items():
+            if key in data:
+                setattr(obs, attr, data[key])
+
+        # files written before the coordinates were parsed at ingest have the raw text
+        problem = obs.set_coordinates(obs.ra, obs.dec)
+        if problem is not None:
+            if problems is None:
+                print(problem)
+            else:
+                problems.append((obs, problem))
+        return obs
+
+    def to_json(self):
+        data = self.to_dict()
+        for (key, attr) in observation_fields.items():
+            if getattr(self, attr) is not None:
+                data[key] = getattr(self, attr)
+        return data
+
+    def visit_name(self):
+        return self.visit_id.replace(":", "_")
+
+    def set_coordinates(self, ra, dec):
+        # Takes RA/Dec in any form parse_ra/parse_dec understand and stores them in degrees. Values
+        # that can't be read or are out of range leave the position unknown and come back as a message.
+        self.ra = None
+        self.dec = None
+        missing = lambda v: v is None or (isinstance(v, str) and len(v.strip()) == 0)
+        if missing(ra) and missing(dec):
+            return None
+        if missing(dec):
+            return f"{self.visit_id}: RA given without Dec"
+        if missing(ra):
+            return f"{self.visit_id}: Dec given without RA"
+
+        try:
+            (ra, dec) = (parse_ra(ra), parse_dec(dec))
+        except ValueError as e:
+            return f"{self.visit_id}: {e}"
+        (self.ra, self.dec) = (ra, dec)
+        return None
+
 stellarium_script_prelude = """
 // pause time playback
 core.setTimeRate(0)
@@ -86,9 +442,9 @@ core.quitStellarium()
 """
 
 def add_stellarium_obs(obs):
-    date = obs["SCHEDULED START TIME"][:-1]
-    ra = f'"{obs["ra"]}"'
-    dec = f'"{obs["dec"]}"'
+    date = obs.start.strftime("%Y-%m-%dT%H:%M:%S")
+    ra = f'"{format_ra(obs.ra)}"'
+    dec = f'"{format_dec(obs.dec)}"'
     return f"""
 // set date
 core.setDate("{date}", "utc", true)
@@ -100,7 +456,7 @@ core.moveToRaDecJ2000({ra}, {dec}, 0)
 MarkerMgr.markerEquatorial({ra}, {dec}, true, true, "cross", "#ff3366", 15.0, false, 0, true)
 
 // take screenshot
-core.screenshot("screenshot_{obs["VISIT ID"].replace(":", "_")}", false, "", true, "")
+core.screenshot("{screenshot_file(obs).removesuffix('.png')}", false, "", true, "")
 
 MarkerMgr.deleteAllMarkers()
 
@@ -108,47 +464,65 @@ core.wait(0.1)
 
 """
 
-def parse_observations(input_file):
-    lines = []
+def iter_observations(input_file):
+    # Streams the schedule one row at a time. Attached rows are folded into their prime while reading,
+    # rows without a VISIT ID and calibration rows are dropped before they are collected.
     with open(input_file, 'r') as file:
-        lines = file.readlines()
+        header_lines = [file.readline() for _ in range(first_obs_line - 1)]
+        layout = ScheduleLayout(get_categories(header_lines))
+
+        prime = None
+        for line in file:
+            row = layout.parse(line)
+
+            if row.scheduled_start_time == '^ATTACHED TO PRIME^':
+                # attached to a dropped prime (e.g. a calibration) means it gets dropped as well
+                if prime is not None:
+                    prime.visit_type.update(row.visit_type)
+                    prime.science_instrument_and_mode.update(row.science_instrument_and_mode)
+                continue
 
-    cats = get_categories(lines)
-    observations = []
+            if row.visit_id == "":
+                # it would be nice to list all the targets, but for now we'll just list the primary one
+                continue
 
-    for i in range(first_obs_line, len(lines)):
-        observations.append(parse_line(lines, i, cats))
+            if prime is not None:
+                yield finish_observation(prime)
 
-    # deduplicate attached observations
-    i = 0
-    while i < len(observations):
-        if observations[i]['SCHEDULED START TIME'] == '^ATTACHED TO PRIME^':
-            observations[i-1]['VISIT TYPE'].update(observations[i]['VISIT TYPE'])
-            observations[i-1]['SCIENCE INSTRUMENT AND MODE'].update(observations[i]['SCIENCE INSTRUMENT AND MODE'])
-            observations.pop(i)
-        elif observations[i]["VISIT ID"] == "":
+            prime = row if row.category != "Calibration" else None
 
-            # it would be nice to list all the targets, but for now we'll just list the primary one
+        if prime is not None:
+            yield finish_observation(prime)
 
-            observations.pop(i)
-        elif observations[i]["CATEGORY"] == "Calibration":
-            observations.pop(i)
-        else:
-            i += 1
+def finish_observation(row):
+    obs = Observation.from_row(row)
 
     # turn sets into lists again
-    for obs in observations:
-        # 'VISIT TYPE' | 'SCIENCE INSTRUMENT AND MODE'
-        cats = ['VISIT TYPE', 'SCIENCE INSTRUMENT AND MODE']
+    obs.visit_type = list(obs.visit_type)
+    obs.science_instrument_and_mode = list(obs.science_instrument_and_mode)
+    return obs
+
+def parse_observations(input_file):
+    return list(iter_observations(input_file))
+
+class ObservationIndex:
+    # Proposal id and VISIT ID multimaps over the observations. Built once and shared by every
+    # enrichment step instead of scanning all observations for each proposal or CSV row.
+    def __init__(self, observations):
+        self.by_proposal = dict()
+        self.by_visit = dict()
+        for obs in observations:
+            self.by_proposal.setdefault(obs.proposal, []).append(obs)
+            self.by_visit.setdefault(obs.visit_id, []).append(obs)
 
-        for cat in cats:
-            obs[cat] = list(obs[cat])
+    def proposal(self, proposal_id):
+        return self.by_proposal.get(proposal_id, [])
 
-    return observations
+    def visit(self, visit_id):
+        return self.by_visit.get(visit_id, [])
 
 def obs_visit_id_key(obs):
-    nums = obs["VISIT ID"].split(':')
-    return int(nums[0]) * 1_000_000_000_000 + int(nums[1]) * 1_000_000 + int(nums[2])
+    return (obs.proposal, obs.observation, obs.visit)
 
 def prepare_csv(observations, out_file):
     # Sort by VISIT ID
@@ -171,27 +545,24 @@ def prepare_csv(observations, out_file):
         ])
 
         for obs in sorted_obs:
-            if "ra" in obs:
+            if obs.ra is not None:
                 continue
 
-            proposal_id = int(obs['VISIT ID'].split(':')[0])
-            obs_id = int(obs['VISIT ID'].split(':')[1])
-            obs_2nd_num = int(obs['VISIT ID'].split(':')[2])
-            proposal_link = f"https://www.stsci.edu/jwst/phase2-public/{proposal_id}.pdf"
+            proposal_link = proposal_url(obs.proposal)
 
-            val_or_empty = lambda k: obs[k] if k in obs else ""
+            val_or_empty = lambda v: v if v is not None else ""
 
-            ra = val_or_empty("ra")
-            dec = val_or_empty("dec")
-            pi = val_or_empty("pi name")
-            pi_inst = val_or_empty("pi institution")
-            title = val_or_empty("title")
-            abstract = val_or_empty("abstract")
+            ra = val_or_empty(obs.ra)
+            dec = val_or_empty(obs.dec)
+            pi = val_or_empty(obs.pi_name)
+            pi_inst = val_or_empty(obs.pi_institution)
+            title = val_or_empty(obs.title)
+            abstract = val_or_empty(obs.abstract)
 
             writer.writerow([
-                proposal_id,
-                obs_id,
-                obs_2nd_num,
+                obs.proposal,
+                obs.observation,
+                obs.visit,
                 proposal_link,
                 ra,
                 dec,
@@ -201,29 +572,399 @@ def prepare_csv(observations, out_file):
                 abstract,
             ])
 
-def try_autofill_data(observations):
-    visit_ids = set()
-    for obs in observations:
-        visit_ids.add(int(obs["VISIT ID"].split(":")[0]))
+page_text_stats = {
+    "extractions": 0,
+    "saved": 0,
+}
+
+class ProposalPages:
+    # Wraps `reader.pages` so that every page's layout text is extracted at most once per proposal
+    # and only once something actually looks at it.
+    def __init__(self, reader_pages):
+        self.reader_pages = reader_pages
+        self.pages = [None] * len(reader_pages)
+        self.extractions = 0
+        self.lookups = 0
+
+    def __len__(self):
+        return len(self.pages)
+
+    def __getitem__(self, i):
+        if self.pages[i] is None:
+            self.pages[i] = ProposalPage(self, i)
+        return self.pages[i]
+
+    def saved(self):
+        return self.lookups - self.extractions
+
+class ProposalPage:
+    def __init__(self, pages, index):
+        self.owner = pages
+        self.index = index
+        self.text_lines = None
+
+    def lines(self):
+        self.owner.lookups += 1
+        if self.text_lines is None:
+            self.owner.extractions += 1
+            self.text_lines = self.owner.reader_pages[self.index].extract_text(extraction_mode="layout").splitlines()
+        return self.text_lines
+
+proposal_url_base = "https://www.stsci.edu/jwst/phase2-public"
+download_workers = 8
+download_timeout = 60
+revalidate_cache = False
+remote_pdfs = False
+
+parse_jobs = 1
+parse_timeout = 120
+
+def proposal_url(proposal_id):
+    return f"{proposal_url_base}/{proposal_id}.pdf"
+
+# one keep-alive connection per host and download thread
+http_connections = threading.local()
+
+def http_get_connection(parts):
+    if not hasattr(http_connections, "by_host"):
+        http_connections.by_host = dict()
+
+    key = (parts.scheme, parts.netloc)
+    if key not in http_connections.by_host:
+        if parts.scheme == "https":
+            http_connections.by_host[key] = http.client.HTTPSConnection(parts.netloc, timeout = download_timeout)
+        else:
+            http_connections.by_host[key] = http.client.HTTPConnection(parts.netloc, timeout = download_timeout)
+    return http_connections.by_host[key]
+
+def http_drop_connection(parts):
+    key = (parts.scheme, parts.netloc)
+    if hasattr(http_connections, "by_host") and key in http_connections.by_host:
+        http_connections.by_host.pop(key).close()
+
+def http_request(url, headers = None, out_file = None, method = "GET", max_redirects = 5):
+    # Returns (status, response headers, body). With `out_file` a 200 response body is streamed into
+    # that file instead and the returned body is None.
+    for _ in range(max_redirects + 1):
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path if parts.query == "" else f"{parts.path}?{parts.query}"
+
+        response = None
+        for attempt in range(2):
+            conn = http_get_connection(parts)
+            try:
+                conn.request(method, path, headers = headers or dict())
+                response = conn.getresponse()
+                break
+            except (http.client.RemoteDisconnected, http.client.CannotSendRequest, ConnectionResetError, BrokenPipeError):
+                # the server closed our kept-alive connection in the meantime, reconnect once
+                http_drop_connection(parts)
+                if attempt == 1:
+                    raise
+
+        try:
+            if response.status in (301, 302, 303, 307, 308) and response.getheader("Location") is not None:
+                response.read()
+                url = urllib.parse.urljoin(url, response.getheader("Location"))
+                continue
+
+            body = None
+            if out_file is not None and response.status == 200:
+                shutil.copyfileobj(response, out_file)
+            else:
+                body = response.read()
+
+            return (response.status, response.headers, body)
+        except Exception:
+            http_drop_connection(parts)
+            raise
+        finally:
+            if response.will_close:
+                http_drop_connection(parts)
+
+    raise Exception(f"too many redirects for {url}")
+
+def proposal_validators_path(vid):
+    return f"cache/{vid}.http.json"
+
+def load_proposal_validators(vid):
+    try:
+        with open(proposal_validators_path(vid), 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return dict()
+
+def download_proposal(vid):
+    # Downloads into a temporary file first so that an interrupted download never leaves a
+    # half-written PDF in the cache. If the PDF is already cached, the request is made conditional on
+    # its stored ETag / Last-Modified. Returns False if the server answered that it is unchanged.
+    pdf_path = f"cache/{vid}.pdf"
+
+    headers = dict()
+    if os.path.isfile(pdf_path):
+        validators = load_proposal_validators(vid)
+        if "etag" in validators:
+            headers["If-None-Match"] = validators["etag"]
+        if "last_modified" in validators:
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+    (fd, tmp_path) = tempfile.mkstemp(prefix = f"{vid}.", suffix = ".part", dir = "cache/")
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            (status, response_headers, _) = http_request(proposal_url(vid), headers = headers, out_file = file)
+        if status == 304 and len(headers) > 0:
+            os.remove(tmp_path)
+            return False
+        if status != 200:
+            raise Exception(f"HTTP {status}")
+
+        # never leave the old validators next to the new PDF
+        if os.path.isfile(proposal_validators_path(vid)):
+            os.remove(proposal_validators_path(vid))
+        os.replace(tmp_path, pdf_path)
+    except BaseException:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    validators = dict()
+    if response_headers.get("ETag") is not None:
+        validators["etag"] = response_headers.get("ETag")
+    if response_headers.get("Last-Modified") is not None:
+        validators["last_modified"] = response_headers.get("Last-Modified")
+    if len(validators) > 0:
+        with open(proposal_validators_path(vid), 'w') as file:
+            json.dump(validators, file)
+
+    return True
+
+def download_proposals(vids, workers = None):
+    # Returns the proposal ids that could not be downloaded.
+    failed = []
+    unchanged = 0
+    with ThreadPoolExecutor(max_workers = workers or download_workers) as pool:
+        futures = {pool.submit(download_proposal, vid): vid for vid in vids}
+        for future in as_completed(futures):
+            vid = futures[future]
+            try:
+                if future.result():
+                    print(f"Downloaded proposal #{vid}")
+                else:
+                    unchanged += 1
+            except Exception as e:
+                print(f"Failed to download proposal #{vid}: {e}")
+                failed.append(vid)
+
+    if unchanged > 0:
+        print(f"{unchanged} cached proposal(s) unchanged on the server")
+
+    return failed
+
+range_block_size = 1 << 14
+
+class HttpRangeFile(io.RawIOBase):
+    # Read-only, seekable file object over a remote file that fetches only the blocks that actually get
+    # read, using HTTP Range requests. PdfReader only touches the trailer, the xref and the objects of
+    # the pages the parser looks at, so for long proposals most of the PDF is never transferred.
+    # If the server ignores the Range header, the first response already is the full file and it is
+    # served from memory instead.
+    def __init__(self, url, block_size = None):
+        self.url = url
+        self.block_size = block_size or range_block_size
+        self.blocks = dict()
+        self.position = 0
+        self.bytes_fetched = 0
+        self.requests = 0
+        self.data = None
+
+        (status, headers, body) = self.fetch(f"bytes=0-{self.block_size - 1}")
+        match status:
+            case 206:
+                self.size = int(headers.get("Content-Range").split("/")[1])
+                self.store_blocks(0, body)
+            case 200:
+                self.data = body
+                self.size = len(body)
+            case _:
+                raise Exception(f"HTTP {status}")
+
+    def fetch(self, byte_range):
+        (status, headers, body) = http_request(self.url, headers = {"Range": byte_range})
+        self.requests += 1
+        self.bytes_fetched += len(body)
+        return (status, headers, body)
+
+    def store_blocks(self, first_block, body):
+        for i in range(0, len(body), self.block_size):
+            self.blocks[first_block + i // self.block_size] = body[i:i + self.block_size]
+
+    def load_blocks(self, first_block, last_block):
+        # fetch every run of consecutive missing blocks with a single request
+        block = first_block
+        while block <= last_block:
+            if block in self.blocks:
+                block += 1
+                continue
+            run_end = block
+            while run_end + 1 <= last_block and run_end + 1 not in self.blocks:
+                run_end += 1
+            start = block * self.block_size
+            end = min((run_end + 1) * self.block_size, self.size) - 1
+            (status, _, body) = self.fetch(f"bytes={start}-{end}")
+            if status != 206:
+                raise Exception(f"HTTP {status} for range {start}-{end}")
+            self.store_blocks(block, body)
+            block = run_end + 1
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        match whence:
+            case io.SEEK_SET:
+                self.position = offset
+            case io.SEEK_CUR:
+                self.position += offset
+            case io.SEEK_END:
+                self.position = self.size + offset
+        return self.position
+
+    def readinto(self, buffer):
+        n = max(0, min(len(buffer), self.size - self.position))
+        if n == 0:
+            return 0
+
+        if self.data is not None:
+            buffer[:n] = self.data[self.position:self.position + n]
+        else:
+            first_block = self.position // self.block_size
+            last_block = (self.position + n - 1) // self.block_size
+            self.load_blocks(first_block, last_block)
+            chunk = b"".join(self.blocks[b] for b in range(first_block, last_block + 1))
+            offset = self.position - first_block * self.block_size
+            buffer[:n] = chunk[offset:offset + n]
+
+        self.position += n
+        return n
+
+class LazyPdfPages:
+    # `reader.pages` loads every page object of the document as soon as any page is accessed.
+    # This walks the page tree down to the requested page instead, so that an HttpRangeFile only
+    # fetches the pages the parser actually reads.
+    inheritable = ("/Resources", "/MediaBox", "/CropBox", "/Rotate")
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.root = reader.trailer["/Root"]["/Pages"].get_object()
+
+    def __len__(self):
+        return int(self.root["/Count"])
+
+    def __getitem__(self, i):
+        if i < 0 or i >= len(self):
+            raise IndexError(f"page {i} out of range")
+
+        node = self.root
+        node_ref = None
+        inherited = dict()
+        while "/Kids" in node:
+            for key in LazyPdfPages.inheritable:
+                if key in node:
+                    inherited[key] = node[key]
+            for kid_ref in node["/Kids"]:
+                kid = kid_ref.get_object()
+                kid_pages = int(kid["/Count"]) if "/Kids" in kid else 1
+                if i < kid_pages:
+                    node = kid
+                    node_ref = kid_ref
+                    break
+                i -= kid_pages
+
+        page = PageObject(self.reader, node_ref.indirect_reference)
+        page.update(node)
+        for (key, value) in inherited.items():
+            if key not in page:
+                page[NameObject(key)] = value
+        return page
+
+proposal_parser_version = 1
+
+proposal_cache_stats = {
+    "hits": 0,
+    "misses": 0,
+    "seconds_saved": 0.0,
+}
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def proposal_cache_path(vid):
+    return f"cache/{vid}.json"
+
+def load_cached_proposal(vid, sha256):
+    # Returns the stored proposal_parse output if it was made from the same PDF by the same parser version.
+    try:
+        with open(proposal_cache_path(vid), 'r') as file:
+            entry = json.load(file)
+    except (OSError, ValueError):
+        return None
+
+    if entry.get("parser_version") != proposal_parser_version or entry.get("sha256") != sha256:
+        return None
+
+    # json turned the int keys into strings and the tuples into lists
+    proposal = entry["proposal"]
+    if proposal["investigators"] is not None:
+        proposal["investigators"] = [tuple(inv) for inv in proposal["investigators"]]
+    if proposal["observations"] is not None:
+        proposal["observations"] = {int(k): tuple(v) for (k, v) in proposal["observations"].items()}
+    proposal["targets"] = {int(k): (v[0], tuple(v[1]) if v[1] is not None else None) for (k, v) in proposal["targets"].items()}
+    return proposal
+
+def store_cached_proposal(vid, sha256, proposal):
+    entry = {
+        "parser_version": proposal_parser_version,
+        "sha256": sha256,
+        "proposal": proposal,
+    }
+    tmp_path = f"{proposal_cache_path(vid)}.part"
+    with open(tmp_path, 'w') as file:
+        json.dump(entry, file, ensure_ascii = True)
+    os.replace(tmp_path, proposal_cache_path(vid))
+
+def try_autofill_data(observations, resolved = None):
+    if resolved is None:
+        resolved = set()
+    index = ObservationIndex(observations)
+    visit_ids = set(index.by_proposal) - resolved
     print("Downloading all proposal PDFs...")
 
     if not os.path.exists("cache/"):
         os.makedirs("cache/")
 
-    no_proposal = []
-    for vid in visit_ids:
-        if not os.path.isfile(f"cache/{vid}.pdf"):
-            success = True
-            print(f"Downloading proposal #{vid}...", end='')
-            try:
-                urllib.request.urlretrieve(f"https://www.stsci.edu/jwst/phase2-public/{vid}.pdf", f"cache/{vid}.pdf")
-            except Exception:
-                success = False
-                print(f" Failed!")
-                no_proposal.append(vid)
+    # with --remote, proposals that are not cached yet are parsed straight from the server instead
+    remote = []
+    if remote_pdfs:
+        remote = [vid for vid in visit_ids if not os.path.isfile(f"cache/{vid}.pdf")]
+
+    with profiler.stage("download"):
+        if revalidate_cache:
+            failed = download_proposals([vid for vid in visit_ids if vid not in remote])
+        else:
+            failed = download_proposals([vid for vid in visit_ids if not os.path.isfile(f"cache/{vid}.pdf") and vid not in remote])
 
-            if success:
-                print(" Done!")
+    # a proposal that failed to revalidate can still be parsed from the cached copy
+    no_proposal = [vid for vid in failed if not os.path.isfile(f"cache/{vid}.pdf")]
 
     if len(no_proposal) > 0:
         print(f"Failed to download {len(no_proposal)} proposal(s). Please fill out details manually in the generated CSV file!")
@@ -233,36 +974,159 @@ def try_autofill_data(observations):
 
     print("Done retrieving PDFs")
 
+    proposals = dict()
+    pdf_hashes = dict()
     for vid in visit_ids:
-        try_parse_proposal_data(vid, observations)
-
-    return observations
+        if vid in remote:
+            continue
+        pdf_hashes[vid] = file_sha256(f"cache/{vid}.pdf")
+        cached = load_cached_proposal(vid, pdf_hashes[vid])
+        if cached is None:
+            proposal_cache_stats["misses"] += 1
+            continue
+        proposal_cache_stats["hits"] += 1
+        proposal_cache_stats["seconds_saved"] += cached["seconds"]
+        proposals[vid] = cached
+
+    with profiler.stage("pdf_parse"):
+        parsed = parse_proposals([vid for vid in visit_ids if vid not in proposals], urls = {vid: proposal_url(vid) for vid in remote})
+    for (vid, proposal) in parsed.items():
+        profiler.record_proposal(vid, proposal)
+        # remotely parsed proposals have no local PDF to hash
+        if vid in pdf_hashes:
+            store_cached_proposal(vid, pdf_hashes[vid], proposal)
+    proposals.update(parsed)
+
+    if len(remote) > 0:
+        fetched = sum(parsed[vid]["bytes_fetched"] for vid in remote if vid in parsed)
+        total = sum(parsed[vid]["bytes_total"] for vid in remote if vid in parsed)
+        print(f"Parsed {len([vid for vid in remote if vid in parsed])} proposal(s) remotely, fetched {fetched} of {total} bytes ({100 * fetched / max(total, 1):.1f}%)")
+
+        no_remote = [vid for vid in remote if vid not in parsed]
+        if len(no_remote) > 0:
+            print(f"Failed to fetch {len(no_remote)} proposal(s). Please fill out details manually in the generated CSV file!")
 
-def try_parse_proposal_data(vid, observations):
-    proposal_title = ""
-    proposal_investigators = []
-    proposal_abstract = ""
-    proposal_observations = dict()
-    proposal_targets = dict()
+    for vid in visit_ids:
+        if vid in proposals:
+            apply_proposal_data(vid, proposals[vid], index)
 
-    with PdfReader(f"cache/{vid}.pdf") as reader:
-        proposal_title = proposal_get_title(reader.pages, vid)
-        proposal_investigators = proposal_get_co_investigators(reader.pages, vid)
-        proposal_abstract = proposal_get_abstract(reader.pages, vid)
-        proposal_observations = proposal_get_observations(reader.pages, vid)
-        proposal_targets = proposal_get_targets(reader.pages, vid)
+    print(f"Extracted text of {page_text_stats['extractions']} page(s), saved {page_text_stats['saved']} redundant extraction(s)")
+    print(f"Proposal cache: {proposal_cache_stats['hits']} hit(s), {proposal_cache_stats['misses']} miss(es), saved {proposal_cache_stats['seconds_saved']:.2f} seconds of PDF parsing")
 
-    for obs in observations:
-        if int(obs["VISIT ID"].split(":")[0]) != vid:
-            continue
-
-        obs["title"] = proposal_title
-        obs["pi name"] = proposal_investigators[0][0]
-        obs["pi institution"] = proposal_investigators[0][1]
-        obs["abstract"] = proposal_abstract
-        obs["co-investigators"] = proposal_investigators[1:]
+    return observations
 
-        obs_id = int(obs["VISIT ID"].split(":")[1])
+def parse_proposal_file(vid, url = None):
+    # Runs in the parse workers, so only plain data goes back to the parent process.
+    # With `url` the PDF is read from the server through HTTP Range requests instead of from the cache.
+    start = time.perf_counter()
+    if url is None:
+        with PdfReader(f"cache/{vid}.pdf") as reader:
+            pages = ProposalPages(reader.pages)
+            proposal = proposal_parse(pages, vid)
+    else:
+        source = HttpRangeFile(url)
+        try:
+            # non-strict mode validates the header of every object in the xref, which touches the whole file
+            reader = PdfReader(source, strict = True)
+        except Exception:
+            reader = PdfReader(source)
+        pages = ProposalPages(LazyPdfPages(reader))
+        proposal = proposal_parse(pages, vid)
+
+        proposal["bytes_fetched"] = source.bytes_fetched
+        proposal["bytes_total"] = source.size
+        if source.data is not None:
+            # the server doesn't support ranges and sent the whole file, so keep it
+            (fd, tmp_path) = tempfile.mkstemp(prefix = f"{vid}.", suffix = ".part", dir = "cache/")
+            with os.fdopen(fd, 'wb') as file:
+                file.write(source.data)
+            os.replace(tmp_path, f"cache/{vid}.pdf")
+
+    proposal["extractions"] = pages.extractions
+    proposal["saved"] = pages.saved()
+    proposal["seconds"] = time.perf_counter() - start
+    return proposal
+
+def parse_proposal_worker_init(started, cprofile):
+    global parse_started, parse_cprofile
+    parse_started = started
+    parse_cprofile = cprofile
+
+def parse_proposal_worker(vid, url):
+    parse_started.put((vid, time.monotonic()))
+    if not parse_cprofile:
+        return parse_proposal_file(vid, url)
+
+    # --profile-stage pdf_parse: the parsing happens here, the parent only waits for the results
+    profile = cProfile.Profile()
+    proposal = profile.runcall(parse_proposal_file, vid, url)
+    profile.create_stats()
+    proposal["cprofile_stats"] = profile.stats
+    return proposal
+
+def parse_proposals(vids, jobs = None, timeout = None, urls = None):
+    # Parses the cached proposal PDFs in a process pool and returns the results by proposal id.
+    # A proposal that takes longer than `timeout` seconds is reported and skipped. As the stuck worker
+    # can't be stopped on its own, the pool is torn down and the unfinished proposals go to a fresh one.
+    jobs = jobs or parse_jobs
+    timeout = timeout if timeout is not None else parse_timeout
+    urls = urls or dict()
+
+    results = dict()
+    remaining = list(vids)
+    while len(remaining) > 0:
+        started = multiprocessing.Queue()
+        pool = multiprocessing.Pool(min(jobs, len(remaining)), initializer = init_worker_process, initargs = (parse_proposal_worker_init, started, profiler.profiling("pdf_parse")))
+
+        pending = {vid: pool.apply_async(parse_proposal_worker, (vid, urls.get(vid))) for vid in remaining}
+        start_times = dict()
+        timed_out = False
+        while len(pending) > 0 and not timed_out:
+            while not started.empty():
+                (vid, t) = started.get()
+                start_times[vid] = t
+
+            for vid in list(pending):
+                if pending[vid].ready():
+                    try:
+                        results[vid] = pending.pop(vid).get()
+                        if "cprofile_stats" in results[vid]:
+                            profiler.add_worker_cprofile_stats(results[vid].pop("cprofile_stats"))
+                    except Exception as e:
+                        print(f"Failed to parse proposal #{vid}: {e}")
+                elif timeout > 0 and vid in start_times and time.monotonic() - start_times[vid] > timeout:
+                    print(f"Parsing proposal #{vid} took longer than {timeout} seconds. Skipping it!")
+                    pending.pop(vid)
+                    timed_out = True
+
+            if len(pending) > 0:
+                time.sleep(0.02)
+
+        pool.terminate()
+        pool.join()
+        remaining = list(pending)
+
+    for proposal in results.values():
+        page_text_stats["extractions"] += proposal["extractions"]
+        page_text_stats["saved"] += proposal["saved"]
+
+    return results
+
+def apply_proposal_data(vid, proposal, index):
+    proposal_title = proposal["title"]
+    proposal_investigators = proposal["investigators"]
+    proposal_abstract = proposal["abstract"]
+    proposal_observations = proposal["observations"]
+    proposal_targets = proposal["targets"]
+
+    for obs in index.proposal(vid):
+        obs.title = proposal_title
+        obs.pi_name = proposal_investigators[0][0]
+        obs.pi_institution = proposal_investigators[0][1]
+        obs.abstract = proposal_abstract
+        obs.co_investigators = proposal_investigators[1:]
+
+        obs_id = obs.observation
 
         if obs_id not in proposal_observations:
             print(f"Observation {obs_id} not in proposal {vid}.")
@@ -275,24 +1139,26 @@ def try_parse_proposal_data(vid, observations):
             assert(target_name == target_name_)
 
             if target_coords is not None:
-                obs["ra"] = target_coords[0]
-                obs["dec"] = target_coords[1]
+                problem = obs.set_coordinates(*target_coords)
+                if problem is not None:
+                    print(f"Proposal {vid}, Observation {obs_id}, Science target {target_num}: {problem}")
             else:
                 print(f"Proposal {vid}, Observation {obs_id}, Science target {target_num}: No RA and Dec available.")
 
 
 
 def proposal_header(page):
-    return page.extract_text(extraction_mode="layout").splitlines()[0]
+    return page.lines()[0]
 
 def proposal_is_page_overview(page, proposal_id):
-    return proposal_header(page).startswith(f"JWST Proposal {proposal_id}") and proposal_header(page).endswith("- Overview")
+    header = proposal_header(page)
+    return header.startswith(f"JWST Proposal {proposal_id}") and header.endswith("- Overview")
 
 def proposal_is_page_targets(page, proposal_id):
     return proposal_header(page).startswith(f"Proposal {proposal_id} - Targets")
 
 def proposal_get_lines(page):
-    return page.extract_text(extraction_mode="layout").splitlines()
+    return page.lines()
 
 def proposal_debug_print_line(proposal_id, line, sections):
     print(f"========= {proposal_id} =========")
@@ -301,66 +1167,20 @@ def proposal_debug_print_line(proposal_id, line, sections):
         print(" " * sec[1] + f"^ {sec[0]}")
     print(f"========= {proposal_id} =========")
 
-def proposal_get_observations(pages, proposal_id):
-    observations = dict()
-    observations_block = False
-    for i in range(len(pages)):
-        if not proposal_is_page_overview(pages[i], proposal_id):
-            return None
-        lines = proposal_get_lines(pages[i])
-        obs_col = 0
-        label_col = 0
-        target_col = 0
-        for l in range(1, len(lines) - 1):
-            if lines[l] == "OBSERVATIONS":
-                observations_block = True
-                continue
-            if not observations_block:
-                continue
-            if lines[l].startswith("Folder"):
-                obs_col = lines[l].find("Observation")
-                label_col = lines[l].find("Label")
-                observing_template_col = lines[l].find("Observing Template")
-                target_col = lines[l].find("Science Target")
-                #proposal_debug_print_line(proposal_id, lines[l], [("Observation", obs_col), ("Label", label_col), ("Science Target", target_col)])
-                continue
-            if lines[l] == "ABSTRACT":
-                return observations
-            if lines[l] == "":
-                continue
-            if lines[l][:obs_col].strip() != "":
-                continue
-            if lines[l][obs_col:label_col].strip() == "":
-                continue
-            #proposal_debug_print_line(proposal_id, lines[l], [("Observation", obs_col), ("Label", label_col), ("Science Target", target_col)])
-            obs_num = int(lines[l][obs_col:label_col].strip())
-            # 1. sometimes pypdf messes up and doesn't insert the spaces before the science target, messing up alignment
-            # 2. sometimes there is no target :/
-            science_target_num = None
-            science_target_name = None
-            if "(" in lines[l][observing_template_col:]:
-                science_target_num = int(lines[l][observing_template_col:].split("(")[1].split(")")[0])
-                science_target_name = lines[l][observing_template_col:].split(")")[1].strip()
-            observations[obs_num] = (science_target_num, science_target_name)
-
-def proposal_get_title(pages, proposal_id):
-    for i in range(len(pages)):
-        if not proposal_is_page_overview(pages[i], proposal_id):
-            return None
-        lines = proposal_get_lines(pages[i])
-        # skip the first line as it only contains the header
-        start_line = 0
-        end_line = 0
-        for l in range(1, len(lines)):
-            if lines[l] == "":
-                continue
-            start_line = l
-            for j in range(l+1, len(lines)):
-                if lines[j].startswith("Cycle: "):
-                    end_line = j
-                    break
-            break
-        return " ".join(lines[start_line:end_line])
+def proposal_get_title(lines):
+    # skip the first line as it only contains the header
+    start_line = 0
+    end_line = 0
+    for l in range(1, len(lines)):
+        if lines[l] == "":
+            continue
+        start_line = l
+        for j in range(l+1, len(lines)):
+            if lines[j].startswith("Cycle: "):
+                end_line = j
+                break
+        break
+    return " ".join(lines[start_line:end_line])
 
 def proposal_get_text(pages, proposal_id, start_page, start_line, end_page, end_line):
     lines = []
@@ -374,77 +1194,118 @@ def proposal_get_text(pages, proposal_id, start_page, start_line, end_page, end_
                 lines.append(pl[j])
     return " ".join(lines)
 
-def proposal_get_abstract(pages, proposal_id):
+def proposal_parse(pages, proposal_id):
+    # Single pass over the overview pages (title, INVESTIGATORS, OBSERVATIONS, ABSTRACT) followed by the
+    # targets pages. Reading stops at the first page after the targets section.
+    # Sections that never got closed by the next section's heading stay `None`.
+    proposal = {
+        "title": None,
+        "investigators": None,
+        "observations": None,
+        "abstract": None,
+        "targets": None,
+    }
+
+    section = None
+    co_investigators = []
+    observations = dict()
     abstract_lines = []
-    abstract_block = False
-    for i in range(len(pages)):
-        if not proposal_is_page_overview(pages[i], proposal_id):
-            return None
-        lines = proposal_get_lines(pages[i])
-        for l in range(1, len(lines) - 1):
-            if lines[l] == "ABSTRACT":
-                abstract_block = True
-                continue
-            if not abstract_block:
-                continue
-            if lines[l] == "OBSERVING DESCRIPTION":
-                return " ".join(abstract_lines)
-            if lines[l] == "":
-                continue
-            abstract_lines.append(lines[l])
+    targets = dict()
 
-def proposal_get_co_investigators(pages, proposal_id):
-    co_investigators = []
-    investigator_block = False
-    for i in range(len(pages)):
-        if not proposal_is_page_overview(pages[i], proposal_id):
-            return None
-        lines = proposal_get_lines(pages[i])
-        inst_col = 0
-        for l in range(1, len(lines) - 1):
-            if lines[l] == "INVESTIGATORS":
-                investigator_block = True
-                continue
-            if not investigator_block:
-                continue
-            if lines[l].startswith("Name"):
-                inst_col = lines[l].find("Institution")
-                continue
-            if lines[l] == "OBSERVATIONS":
-                return co_investigators
-            if lines[l] == "":
-                continue
-            name = lines[l][:inst_col].split("(")[0].strip()
-            inst = " ".join(lines[l][inst_col:].replace(",", " - ").split())
-            co_investigators.append((name, inst))
+    inst_col = 0
+    obs_col = 0
+    label_col = 0
+    observing_template_col = 0
 
-def proposal_get_targets(pages, proposal_id):
-    targets = dict()
     for i in range(len(pages)):
-        if proposal_is_page_overview(pages[i], proposal_id):
+        if section != "targets" and proposal_is_page_overview(pages[i], proposal_id):
+            lines = proposal_get_lines(pages[i])
+
+            if i == 0:
+                proposal["title"] = proposal_get_title(lines)
+
+            for l in range(1, len(lines) - 1):
+                match lines[l]:
+                    case "INVESTIGATORS" if proposal["investigators"] is None:
+                        section = "investigators"
+                        continue
+                    case "OBSERVATIONS" if proposal["observations"] is None:
+                        if section == "investigators":
+                            proposal["investigators"] = co_investigators
+                        section = "observations"
+                        continue
+                    case "ABSTRACT" if proposal["abstract"] is None:
+                        if section == "observations":
+                            proposal["observations"] = observations
+                        section = "abstract"
+                        continue
+                    case "OBSERVING DESCRIPTION" if section == "abstract":
+                        proposal["abstract"] = " ".join(abstract_lines)
+                        section = None
+                        continue
+                    case "":
+                        continue
+
+                match section:
+                    case "investigators":
+                        if lines[l].startswith("Name"):
+                            inst_col = lines[l].find("Institution")
+                            continue
+                        name = lines[l][:inst_col].split("(")[0].strip()
+                        inst = " ".join(lines[l][inst_col:].replace(",", " - ").split())
+                        co_investigators.append((name, inst))
+                    case "observations":
+                        if lines[l].startswith("Folder"):
+                            obs_col = lines[l].find("Observation")
+                            label_col = lines[l].find("Label")
+                            observing_template_col = lines[l].find("Observing Template")
+                            #proposal_debug_print_line(proposal_id, lines[l], [("Observation", obs_col), ("Label", label_col), ("Observing Template", observing_template_col)])
+                            continue
+                        if lines[l][:obs_col].strip() != "":
+                            continue
+                        if lines[l][obs_col:label_col].strip() == "":
+                            continue
+                        obs_num = int(lines[l][obs_col:label_col].strip())
+                        # 1. sometimes pypdf messes up and doesn't insert the spaces before the science target, messing up alignment
+                        # 2. sometimes there is no target :/
+                        science_target_num = None
+                        science_target_name = None
+                        if "(" in lines[l][observing_template_col:]:
+                            science_target_num = int(lines[l][observing_template_col:].split("(")[1].split(")")[0])
+                            science_target_name = lines[l][observing_template_col:].split(")")[1].strip()
+                        observations[obs_num] = (science_target_num, science_target_name)
+                    case "abstract":
+                        abstract_lines.append(lines[l])
             continue
+
         if not proposal_is_page_targets(pages[i], proposal_id):
-            return targets
+            break
+
+        section = "targets"
         lines = proposal_get_lines(pages[i])
         name_col = 0
         target_coords_col = 0
-        target_coords_corrections_col = 0
         for l in range(1, len(lines) - 1):
-            if len(lines) > 0 and lines[l].lstrip().startswith("("):
-                if name_col == 0:
-                    items = list(filter(lambda s: len(s) > 0, map(lambda s: s.strip(), lines[l].split("   "))))
-                    name_col = lines[l].find(items[1])
-                    target_coords_col = lines[l].find(items[2])
-                target_num = int(lines[l][:name_col].split("(")[1].split(")")[0])
-                target_name = lines[l][name_col:target_coords_col].strip()
-                target_coords = None
-                if lines[l][target_coords_col:].startswith("RA:"):
-                    ra = lines[l][target_coords_col:].split("(")[1].split(")")[0]
-                    dec = lines[l+1][target_coords_col:].split("(")[1].split(")")[0]
-                    target_coords = (ra, dec)
-                targets[target_num] = (target_name, target_coords)
-
-def insert_position_data(observations, csv_file):
+            if not lines[l].lstrip().startswith("("):
+                continue
+            if name_col == 0:
+                items = list(filter(lambda s: len(s) > 0, map(lambda s: s.strip(), lines[l].split("   "))))
+                name_col = lines[l].find(items[1])
+                target_coords_col = lines[l].find(items[2])
+            target_num = int(lines[l][:name_col].split("(")[1].split(")")[0])
+            target_name = lines[l][name_col:target_coords_col].strip()
+            target_coords = None
+            if lines[l][target_coords_col:].startswith("RA:"):
+                ra = lines[l][target_coords_col:].split("(")[1].split(")")[0]
+                dec = lines[l+1][target_coords_col:].split("(")[1].split(")")[0]
+                target_coords = (ra, dec)
+            targets[target_num] = (target_name, target_coords)
+
+    proposal["targets"] = targets
+
+    return proposal
+
+def insert_position_data(index, csv_file):
     csv_data = []
     with open(csv_file) as file:
         for line in file.readlines()[1:]:
@@ -460,13 +1321,17 @@ def insert_position_data(observations, csv_file):
 
             csv_data.append((visit_id, ra, dec))
 
+    problems = []
     for (visit_id, ra, dec) in csv_data:
-        for obs in observations:
-            if obs["VISIT ID"] == visit_id:
-                obs["ra"] = ra
-                obs["dec"] = dec
-
-def insert_manual_csv_data(observations, csv_file):
+        for obs in index.visit(visit_id):
+            problem = obs.set_coordinates(ra, dec)
+            if problem is not None:
+                problems.append(problem)
+    return problems
+
+def insert_manual_csv_data(index, csv_file):
+    # Returns the visits whose RA/Dec couldn't be used
+    problems = []
     with open(csv_file) as file:
         reader = csv.reader(file)
         for line in reader:
@@ -487,60 +1352,368 @@ def insert_manual_csv_data(observations, csv_file):
             title = val(8)
             abstract = val(9)
 
-            for obs in observations:
-                if obs["VISIT ID"] == visit_id:
-                    obs["title"] = title
-                    obs["abstract"] = abstract
-                    obs["pi name"] = pi
-                    obs["pi institution"] = pi_inst
-                    if "co-investigators" not in obs:
-                        obs["co-investigators"] = []
-                    obs["ra"] = ra
-                    obs["dec"] = dec
+            for obs in index.visit(visit_id):
+                obs.title = title
+                obs.abstract = abstract
+                obs.pi_name = pi
+                obs.pi_institution = pi_inst
+                if obs.co_investigators is None:
+                    obs.co_investigators = []
+                problem = obs.set_coordinates(ra, dec)
+                if problem is not None:
+                    problems.append(problem)
+    return problems
+
+def write_preprocess_outputs(input_file, observations):
+    prepare_csv(observations, input_file + '.manual.csv')
+
+    with open(input_file + '.auto.json', 'w') as file:
+        json.dump([obs.to_json() for obs in observations], file, ensure_ascii = True, indent = 2)
+
+def batch_schedule_files(pattern):
+    if os.path.isdir(pattern):
+        return sorted(glob.glob(os.path.join(pattern, "*.txt")))
+    return sorted(glob.glob(pattern))
+
+def batch_preprocess(input_files):
+    # Preprocesses many schedules at once. All schedules share one round of downloading and parsing,
+    # so a proposal showing up in several weeks is fetched and parsed only once.
+    schedules = dict()
+    with profiler.stage("schedule_parse"):
+        for input_file in input_files:
+            schedules[input_file] = parse_observations(input_file)
+
+    all_observations = [obs for observations in schedules.values() for obs in observations]
+    print(f"Parsed {len(schedules)} schedule(s) with {len(all_observations)} observation(s) of {len(set(obs.proposal for obs in all_observations))} distinct proposal(s)")
+
+    try_autofill_data(all_observations)
+
+    with profiler.stage("csv_write"), ProcessPoolExecutor(max_workers = parse_jobs, initializer = init_worker_process) as pool:
+        futures = [pool.submit(write_preprocess_outputs, input_file, observations) for (input_file, observations) in schedules.items()]
+        for future in futures:
+            future.result()
+
+    name_width = max(len("Schedule"), *(len(input_file) for input_file in schedules))
+    print(f"\n{'Schedule'.ljust(name_width)}  Visits  Proposals  Resolved  Manual CSV")
+    for (input_file, observations) in schedules.items():
+        resolved = len([obs for obs in observations if obs.title is not None and obs.ra is not None])
+        manual = len([obs for obs in observations if obs.ra is None])
+        print(f"{input_file.ljust(name_width)}  {len(observations):>6}  {len(set(obs.proposal for obs in observations)):>9}  {resolved:>8}  {manual:>10}")
+
+def load_baseline(input_file):
+    # The previous week's observations as `compile` would see them: the .auto.json plus whatever was
+    # filled into its .manual.csv.
+    json_problems = []
+    with open(input_file + '.auto.json', 'r') as file:
+        observations = [Observation.from_json(data, json_problems) for data in json.load(file)]
+
+    problems = []
+    if os.path.isfile(input_file + '.manual.csv'):
+        problems = insert_manual_csv_data(ObservationIndex(observations), input_file + '.manual.csv')
+    problems += [problem for (obs, problem) in json_problems if obs.ra is None]
+    for problem in problems:
+        print(f"Baseline: {problem}, RA/Dec not carried over")
 
-def make_stellarium_script(observations):
-    stellarium_script = stellarium_script_prelude
+    return observations
 
+def apply_baseline(observations, baseline):
+    # Carries proposal details over per proposal and RA/Dec per proposal observation (every visit of
+    # an observation shares its science target). Returns the proposals that are fully resolved.
+    known_proposals = dict()
+    known_positions = dict()
+    for obs in baseline:
+        if obs.title is not None:
+            known_proposals[obs.proposal] = obs
+        if obs.ra is not None and obs.dec is not None:
+            known_positions[(obs.proposal, obs.observation)] = (obs.ra, obs.dec)
+
+    reused_proposals = set()
+    reused_positions = 0
     for obs in observations:
-        if obs["CATEGORY"] == "Calibration":
+        if obs.proposal in known_proposals:
+            known = known_proposals[obs.proposal]
+            obs.title = known.title
+            obs.pi_name = known.pi_name
+            obs.pi_institution = known.pi_institution
+            obs.abstract = known.abstract
+            obs.co_investigators = known.co_investigators
+            reused_proposals.add(obs.proposal)
+
+        if (obs.proposal, obs.observation) in known_positions:
+            (obs.ra, obs.dec) = known_positions[(obs.proposal, obs.observation)]
+            reused_positions += 1
+
+    index = ObservationIndex(observations)
+    resolved = set(pid for (pid, proposal_obs) in index.by_proposal.items() if all(obs.title is not None and obs.ra is not None for obs in proposal_obs))
+
+    print(f"Baseline: reused details of {len(reused_proposals)} proposal(s) and RA/Dec of {reused_positions} visit(s)")
+    print(f"Baseline: {len(resolved)} of {len(index.by_proposal)} proposal(s) fully resolved, only resolving the other {len(index.by_proposal) - len(resolved)}")
+
+    return resolved
+
+def screenshot_file(obs):
+    return obs.screenshot if obs.screenshot is not None else f"screenshot_{obs.visit_name()}.png"
+
+def stellarium_screenshot_observations(observations):
+    # one observation per screenshot file, so visits sharing a screenshot are only rendered once
+    unique = dict()
+    for obs in observations:
+        if obs.category != "Calibration" and obs.ra is not None:
+            unique.setdefault(screenshot_file(obs), obs)
+    return list(unique.values())
+
+def screenshot_key(obs):
+    ra = round(obs.ra % 360 / screenshot_position_step)
+    dec = round(obs.dec / screenshot_position_step)
+    bucket = int(obs.start.timestamp() // screenshot_time_bucket)
+
+    settings = [screenshot_renderer, screenshot_render_version, stellarium_fov, stellarium_projection, stellarium_script_prelude, screenshot_position_step, screenshot_time_bucket]
+    return hashlib.sha256(json.dumps([ra, dec, bucket, settings]).encode()).hexdigest()[:24]
+
+def render_screenshots_builtin(observations, output_dir):
+    # imported here so that NumPy is only needed for the built-in renderer
+    import jwst_sky_renderer
+
+    screenshot_dir = os.path.abspath(os.path.join(output_dir, "screenshots"))
+    jobs = []
+    for obs in stellarium_screenshot_observations(observations):
+        path = os.path.join(screenshot_dir, screenshot_file(obs))
+        if os.path.isfile(path):
             continue
 
-        if "ra" not in obs:
+        jobs.append((path, obs.ra, obs.dec, obs.start.timestamp(), stellarium_fov))
+
+    jwst_sky_renderer.render_many(jobs)
+    print(f"Rendered {len(jobs)} screenshot(s) with the built-in renderer")
+
+def postprocess_screenshot(path, max_size, colors):
+    # Runs in the post-processing workers. Returns the file size before and after; files that are
+    # already small enough (e.g. reused from an earlier week) or wouldn't get any smaller stay as they are.
+    before = os.path.getsize(path)
+    try:
+        with Image.open(path) as image:
+            image.load()
+    except OSError as e:
+        print(f"{os.path.basename(path)}: can't read the screenshot ({e}), leaving it as it is")
+        return (before, before)
+
+    too_big = max_size > 0 and max(image.size) > max_size
+    if not too_big and (image.mode == "P" or colors == 0) and image.info.get("optimized"):
+        return (before, before)
+
+    if too_big:
+        image = image.convert("RGB")
+        image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+    if colors > 0 and image.mode != "P":
+        image = image.convert("RGB").quantize(colors = colors, method = Image.Quantize.FASTOCTREE, dither = Image.Dither.NONE)
+
+    (fd, tmp_path) = tempfile.mkstemp(suffix = ".png", dir = os.path.dirname(path))
+    os.close(fd)
+    # marks the file as processed, so it's left alone when it gets reused in a later week
+    info = PngImagePlugin.PngInfo()
+    info.add_text("optimized", "1")
+    image.save(tmp_path, optimize = True, pnginfo = info)
+    after = os.path.getsize(tmp_path)
+    if after >= before and not too_big:
+        os.remove(tmp_path)
+        return (before, before)
+
+    os.replace(tmp_path, path)
+    return (before, after)
+
+def postprocess_screenshots(output_dir):
+    if Image is None:
+        print("Pillow isn't installed, the screenshots are shipped as rendered")
+        return
+
+    screenshot_dir = os.path.join(output_dir, "screenshots")
+    paths = sorted(glob.glob(os.path.join(screenshot_dir, "*.png")))
+    with ProcessPoolExecutor(initializer = init_worker_process) as pool:
+        process = functools.partial(postprocess_screenshot, max_size = screenshot_max_size, colors = screenshot_colors)
+        sizes = list(pool.map(process, paths, chunksize = 8))
+
+    before = sum(b for (b, _) in sizes)
+    after = sum(a for (_, a) in sizes)
+    print(f"Screenshots: {len(paths)} file(s), {before / 1e6:.1f} MB -> {after / 1e6:.1f} MB")
+    profiler.record("screenshot_bytes", {
+        "week": os.path.basename(os.path.normpath(output_dir)),
+        "files": len(paths),
+        "before": before,
+        "after": after,
+    })
+
+def assign_screenshots(observations, output_dir):
+    # Visits that would get the same screenshot point at one file, named after the first of them.
+    # Screenshots with the same key in earlier output directories are copied over instead of being
+    # rendered again. The key -> file index is written to `screenshot_index.json` for the next weeks.
+    output_dir = os.path.abspath(output_dir)
+    screenshot_dir = os.path.join(output_dir, "screenshots")
+
+    # later directories win, so the most recent copy of a screenshot is used
+    previous = dict()
+    for index_file in sorted(glob.glob(os.path.join(os.path.dirname(output_dir), "*", "screenshot_index.json"))):
+        previous_dir = os.path.dirname(index_file)
+        if previous_dir == output_dir:
             continue
+        with open(index_file, 'r') as file:
+            for (key, name) in json.load(file).items():
+                path = os.path.join(previous_dir, "screenshots", name)
+                if os.path.isfile(path):
+                    previous[key] = path
+
+    files = dict()
+    used_names = set()
+    reused = 0
+    shots = [obs for obs in observations if obs.category != "Calibration" and obs.ra is not None]
+    for obs in shots:
+        key = screenshot_key(obs)
+        if key not in files:
+            # the same visit can show up more than once in a schedule, at different times
+            name = f"screenshot_{obs.visit_name()}.png"
+            n = 1
+            while name in used_names:
+                n += 1
+                name = f"screenshot_{obs.visit_name()}_{n}.png"
+            used_names.add(name)
+            files[key] = name
+            target = os.path.join(screenshot_dir, files[key])
+            if key in previous and not os.path.isfile(target):
+                shutil.copyfile(previous[key], target)
+                reused += 1
+        obs.screenshot = files[key]
+
+    with open(os.path.join(output_dir, "screenshot_index.json"), 'w') as file:
+        json.dump(files, file, indent = 2)
+
+    print(f"Screenshots: {len(shots)} visits share {len(files)} screenshot(s), {reused} reused from earlier weeks")
+
+def make_stellarium_script(observations):
+    stellarium_script = stellarium_script_prelude
 
+    for obs in stellarium_screenshot_observations(observations):
         stellarium_script += add_stellarium_obs(obs)
 
     stellarium_script += stellarium_script_postlude
     return stellarium_script
 
+def stellarium_default_user_dir():
+    match sys.platform:
+        case "win32":
+            return os.path.join(os.environ.get("APPDATA", ""), "Stellarium")
+        case "darwin":
+            return os.path.expanduser("~/Library/Application Support/Stellarium")
+        case _:
+            return os.path.expanduser("~/.stellarium")
+
+def start_stellarium(script_file, screenshot_dir, user_dir = None):
+    args = [
+        stellarium_exe,
+        "--screenshot-dir", screenshot_dir,
+        "--full-screen", "yes",
+        "--fov", str(stellarium_fov),
+        "--projection-type", stellarium_projection,
+        "--startup-script", script_file,
+    ]
+    if user_dir is not None:
+        args += ["--user-dir", user_dir]
+    return subprocess.Popen(args)
+
+def render_screenshots(observations, output_dir, shards = None, retries = None):
+    # Splits the screenshots across `shards` Stellarium instances, each with its own script, screenshot
+    # directory and user directory (so they don't fight over the config and log files), and moves the
+    # results into `output_dir/screenshots/`. Screenshots that didn't show up (e.g. because an instance
+    # crashed) are rendered again, up to `retries` more times. Returns the file names that are still missing.
+    shards = shards if shards is not None else stellarium_shards
+    retries = retries if retries is not None else stellarium_retries
+
+    screenshot_dir = os.path.abspath(os.path.join(output_dir, "screenshots"))
+    shards_dir = os.path.abspath(os.path.join(output_dir, "shards"))
+    pending = {screenshot_file(obs): obs for obs in stellarium_screenshot_observations(observations)}
+    pending = {name: obs for (name, obs) in pending.items() if not os.path.isfile(os.path.join(screenshot_dir, name))}
+
+    config_file = os.path.join(stellarium_default_user_dir(), "config.ini")
+
+    for attempt in range(retries + 1):
+        if len(pending) == 0:
+            break
+        if attempt > 0:
+            print(f"{len(pending)} screenshot(s) missing, rendering them again (attempt {attempt + 1} of {retries + 1})")
+
+        queue = list(pending.values())
+        shard_count = min(shards, len(queue))
+
+        processes = []
+        for i in range(shard_count):
+            shard_dir = os.path.join(shards_dir, str(i))
+            os.makedirs(shard_dir, exist_ok = True)
+
+            script_file = os.path.join(shard_dir, "screenshot_script.ssc")
+            with open(script_file, 'w') as file:
+                file.write(make_stellarium_script(queue[i::shard_count]))
+
+            if shard_count == 1:
+                # a single instance keeps rendering straight into screenshots/ with the normal user directory
+                processes.append((start_stellarium(script_file, screenshot_dir), None))
+                continue
+
+            shard_screenshot_dir = os.path.join(shard_dir, "screenshots")
+            os.makedirs(shard_screenshot_dir, exist_ok = True)
+            user_dir = os.path.join(shard_dir, "user")
+            os.makedirs(user_dir, exist_ok = True)
+            if os.path.isfile(config_file):
+                # same location, landscape and sky settings as a normal run
+                shutil.copy(config_file, user_dir)
+
+            processes.append((start_stellarium(script_file, shard_screenshot_dir, user_dir), shard_screenshot_dir))
+
+        for (process, shard_screenshot_dir) in processes:
+            process.wait()
+            if shard_screenshot_dir is None:
+                continue
+            for name in os.listdir(shard_screenshot_dir):
+                if name in pending:
+                    os.replace(os.path.join(shard_screenshot_dir, name), os.path.join(screenshot_dir, name))
+
+        pending = {name: obs for (name, obs) in pending.items() if not os.path.isfile(os.path.join(screenshot_dir, name))}
+
+    if len(pending) > 0:
+        print(f"WARNING: {len(pending)} screenshot(s) are still missing after {retries + 1} attempt(s):")
+        for name in pending:
+            print(f"  {name}")
+    else:
+        shutil.rmtree(shards_dir, ignore_errors = True)
+
+    return list(pending)
+
 def make_metadata_dict(observations):
     output_array = []
     for obs in observations:
-        if obs["CATEGORY"] == "Calibration":
+        if obs.category == "Calibration":
             continue
 
         output_dict = dict()
 
-        val_or_na = lambda k: obs[k] if (k in obs and obs[k] is not None) else "N/A"
-
-        visit_id = obs["VISIT ID"]
-        output_dict["visit_id"] = visit_id
-        output_dict["proposal_id"] = visit_id.split(":")[0]
-        output_dict["observation"] = visit_id.split(":")[1]
-        output_dict["start_date"] = obs["SCHEDULED START TIME"].split("T")[0]
-        output_dict["start_time"] = obs["SCHEDULED START TIME"].split("T")[1][:-1]
-        output_dict["target_name"] = obs["TARGET NAME"]
-        output_dict["duration"] = obs["DURATION"]
-        output_dict["pi"] = val_or_na("pi name")
-        output_dict["pi_inst"] = val_or_na("pi institution")
-        output_dict["title"] = val_or_na("title")
-        output_dict["image"] = f"screenshot_{obs['VISIT ID'].replace(':', '_')}.png" if ("ra" in obs and obs["ra"] is not None) else "N/A"
-        output_dict["category"] = obs["CATEGORY"]
-        output_dict["keywords"] = obs["KEYWORDS"]
-        output_dict["abstract"] = val_or_na("abstract")
-        output_dict["co-investigators"] = val_or_na("co-investigators")
-
-        inst_plus_modes = [inst for inst in obs["SCIENCE INSTRUMENT AND MODE"] if len(inst) > 0]
+        val_or_na = lambda v: v if v is not None else "N/A"
+
+        output_dict["visit_id"] = obs.visit_id
+        output_dict["proposal_id"] = str(obs.proposal)
+        output_dict["observation"] = str(obs.observation)
+        output_dict["start_date"] = obs.start.strftime("%Y-%m-%d")
+        output_dict["start_time"] = obs.start.strftime("%H:%M:%S")
+        output_dict["start_hour"] = obs.start.hour
+        output_dict["target_name"] = obs.target_name
+        output_dict["duration"] = obs.duration
+        output_dict["duration_seconds"] = obs.duration_seconds
+        output_dict["pi"] = val_or_na(obs.pi_name)
+        output_dict["pi_inst"] = val_or_na(obs.pi_institution)
+        output_dict["title"] = val_or_na(obs.title)
+        output_dict["image"] = screenshot_file(obs) if obs.ra is not None else "N/A"
+        output_dict["category"] = obs.category
+        output_dict["keywords"] = obs.keywords
+        output_dict["abstract"] = val_or_na(obs.abstract)
+        output_dict["co-investigators"] = val_or_na(obs.co_investigators)
+
+        inst_plus_modes = [inst for inst in obs.science_instrument_and_mode if len(inst) > 0]
         output_dict["inst_plus_mode"] = inst_plus_modes
         output_dict["instruments"] = []
 
@@ -552,7 +1725,7 @@ def make_metadata_dict(observations):
                     if inst_mode.startswith("WFSC NIRCam"):
                         output_dict["instruments"].append("NIRCam")
                     else:
-                        print(f"{obs['VISIT ID']}: unrecognized instrument `{inst_mode}`")
+                        print(f"{obs.visit_id}: unrecognized instrument `{inst_mode}`")
                         print("add case for this instrument, then rerun script")
                         exit(1)
         output_array.append(output_dict)
@@ -588,6 +1761,8 @@ def make_chosts(metadata_array):
 
         chost = {
             "post_time": f"{metadata['start_date']} {metadata['start_time']} UTC",
+            # the poster's journal keys posts on this, so a retried post can't go out twice
+            "visit_id": metadata["visit_id"],
         }
 
         chost["title"] = f"{metadata['title']}"
@@ -615,16 +1790,14 @@ def make_chosts(metadata_array):
             })
 
         obs_time = metadata["start_time"]
-        obs_time_h = obs_time.split(":")[0]
-        obs_time_ms = ':'.join(obs_time.split(":")[1:])
-        obs_time_am_pm = "AM" if int(obs_time_h) < 12 else "PM"
-        obs_time_h_12h = "12" if (int(obs_time_h) % 12) == 0 else f"{(int(obs_time_h) % 12):02d}"
+        obs_time_h = metadata["start_hour"]
+        obs_time_ms = obs_time[obs_time.index(":") + 1:]
+        obs_time_am_pm = "AM" if obs_time_h < 12 else "PM"
+        obs_time_h_12h = "12" if (obs_time_h % 12) == 0 else f"{(obs_time_h % 12):02d}"
 
-        obs_duration = metadata["duration"]
-        obs_duration_d = int(obs_duration.split("/")[0])
-        obs_duration_h = int(obs_duration.split("/")[1].split(":")[0])
-        obs_duration_m = int(obs_duration.split("/")[1].split(":")[1])
-        obs_duration_s = int(obs_duration.split("/")[1].split(":")[2])
+        (obs_duration_d, obs_duration_s) = divmod(metadata["duration_seconds"], 24 * 60 * 60)
+        (obs_duration_h, obs_duration_s) = divmod(obs_duration_s, 60 * 60)
+        (obs_duration_m, obs_duration_s) = divmod(obs_duration_s, 60)
 
         obs_duration_out_str = "" if obs_duration_d == 0 else ("1 day " if obs_duration_d == 1 else f"{obs_duration_d} days ")
         obs_duration_out_str += "" if (obs_duration_d == 0 and obs_duration_h == 0) else ("1 hour " if obs_duration_h == 1 else f"{obs_duration_h} hours ")
@@ -720,13 +1893,54 @@ def make_chosts(metadata_array):
     return chosts
 
 
+def take_option(args, name, default, convert = str):
+    # removes `name value` from args and returns the converted value
+    if name not in args:
+        return default
+
+    i = args.index(name)
+    if i + 1 >= len(args):
+        show_help()
+        exit(1)
+
+    value = convert(args[i + 1])
+    del args[i:i + 2]
+    return value
+
+def take_flag(args, name):
+    # removes `name` from args and returns whether it was present
+    if name not in args:
+        return False
+
+    args.remove(name)
+    return True
+
 def show_help():
     print(f"""Usage: python {sys.argv[0]} [command] [args...]
 
         Commands:
             preprocess <input txt file>                                 - Processes the data and outputs CSV file to fill in observation coordinates.
+            batch <directory or glob>                                   - Runs preprocess for many schedule txt files at once, fetching and parsing every proposal only once.
             compile <input txt file> [--exclude <PROPOSAL>*] - Compiles the txt file and the CSV file into the final output. Excludes all listed proposal IDs
             help                                                        - Displays this help page
+
+        Options:
+            --download-workers <N>                                      - Number of parallel proposal downloads (default: {download_workers})
+            --baseline <previous txt file>                              - (preprocess) Reuse the previous week's .auto.json and filled in .manual.csv
+            --revalidate                                                - Re-fetch cached proposal PDFs that changed on the server
+            --remote                                                    - Parse uncached proposals from the server, fetching only the needed byte ranges
+            --jobs <N>                                                  - Number of processes parsing proposal PDFs (default: {parse_jobs})
+            --timeout <SECONDS>                                         - Skip proposals that take longer to parse, 0 to disable (default: {parse_timeout})
+            --shards <N>                                                - (compile) Render the screenshots with N Stellarium instances in parallel (default: {stellarium_shards})
+            --retries <N>                                               - (compile) Render missing screenshots again up to N times (default: {stellarium_retries})
+            --renderer <stellarium|builtin>                             - (compile) Render the screenshots with Stellarium or with the built-in NumPy sky chart (default: {screenshot_renderer})
+            --skip-bad-coordinates                                      - (compile) Compile visits with unreadable RA/Dec without a screenshot instead of stopping
+            --screenshot-max-size <PIXELS>                              - (compile) Scale the screenshots down to fit this size, 0 to keep it (default: {screenshot_max_size})
+            --screenshot-colors <N>                                     - (compile) Reduce the screenshots to an N color palette, 0 for full color (default: {screenshot_colors})
+            --screenshot-bucket <MINUTES>                               - (compile) Visits on the same target starting within the same bucket share a screenshot (default: {screenshot_time_bucket // 60})
+            --profile                                                   - Write a JSON report with time and memory per stage and the slowest proposals
+            --profile-stage <STAGE>                                     - With --profile, also save a cProfile dump of one stage (e.g. pdf_parse, including its parse workers)
+            --profile-slowest <N>                                       - Number of slowest proposals in the profile report (default: 10)
         """)
 
 if __name__ == '__main__':
@@ -736,6 +1950,28 @@ if __name__ == '__main__':
 
     start_time = datetime.datetime.now()
 
+    download_workers = take_option(sys.argv, "--download-workers", download_workers, int)
+    revalidate_cache = take_flag(sys.argv, "--revalidate")
+    remote_pdfs = take_flag(sys.argv, "--remote")
+    baseline_file = take_option(sys.argv, "--baseline", None)
+    parse_jobs = take_option(sys.argv, "--jobs", parse_jobs, int)
+    parse_timeout = take_option(sys.argv, "--timeout", parse_timeout, float)
+    profile_stage = take_option(sys.argv, "--profile-stage", None)
+    profile_slowest = take_option(sys.argv, "--profile-slowest", 10, int)
+    if take_flag(sys.argv, "--profile"):
+        profiler.enable(profile_stage, profile_slowest)
+    profile_report_file = None
+    stellarium_shards = take_option(sys.argv, "--shards", stellarium_shards, int)
+    stellarium_retries = take_option(sys.argv, "--retries", stellarium_retries, int)
+    skip_bad_coordinates = take_flag(sys.argv, "--skip-bad-coordinates")
+    screenshot_max_size = take_option(sys.argv, "--screenshot-max-size", screenshot_max_size, int)
+    screenshot_colors = take_option(sys.argv, "--screenshot-colors", screenshot_colors, int)
+    screenshot_renderer = take_option(sys.argv, "--renderer", screenshot_renderer)
+    if screenshot_renderer not in ["stellarium", "builtin"]:
+        show_help()
+        exit(1)
+    screenshot_time_bucket = take_option(sys.argv, "--screenshot-bucket", screenshot_time_bucket // 60, int) * 60
+
     command = sys.argv[1]
 
     match command:
@@ -748,17 +1984,42 @@ if __name__ == '__main__':
             output_csv_file = input_file + '.manual.csv'
             output_json_file = input_file + '.auto.json'
 
-            observations = parse_observations(input_file)
+            with profiler.stage("schedule_parse"):
+                observations = parse_observations(input_file)
+
+            resolved = set()
+            if baseline_file is not None:
+                resolved = apply_baseline(observations, load_baseline(baseline_file))
+
+            unresolved = [obs for obs in observations if obs.title is None or obs.ra is None]
 
-            observations = try_autofill_data(observations)
-            prepare_csv(observations, output_csv_file)
+            observations = try_autofill_data(observations, resolved)
+            with profiler.stage("csv_write"):
+                write_preprocess_outputs(input_file, observations)
+            profile_report_file = input_file + '.profile.json'
 
-            with open(output_json_file, 'w') as file:
-                json.dump(observations, file, ensure_ascii = True, indent = 2)
+            if baseline_file is not None:
+                newly_resolved = len([obs for obs in unresolved if obs.title is not None and obs.ra is not None])
+                print(f"Baseline: {len(observations) - len(unresolved)} visit(s) reused, {newly_resolved} newly resolved, {len(unresolved) - newly_resolved} left for the manual CSV")
 
             print("\nDone precompiling data")
             print(f"Automatically detected data: {output_json_file}")
             print(f"Please manually fill in missing data in {output_csv_file}. When done, run `compile`.\n")
+        case "batch":
+            if len(sys.argv) != 3:
+                show_help()
+                exit(1)
+
+            input_files = batch_schedule_files(sys.argv[2])
+            if len(input_files) == 0:
+                print(f"No schedule files found for {sys.argv[2]}")
+                exit(1)
+
+            batch_preprocess(input_files)
+            profile_report_file = "batch.profile.json"
+
+            print("\nDone precompiling data")
+            print("Please manually fill in missing data in the generated CSV files. When done, run `compile` for each schedule.\n")
         case "compile":
             if len(sys.argv) < 3:
                 show_help()
@@ -779,50 +2040,74 @@ if __name__ == '__main__':
             manual_csv_file = input_file + '.manual.csv'
             observations_json_file = input_file + '.auto.json'
 
-            # load observations from json file
-            observations = []
-            with open(observations_json_file, 'r') as file:
-                observations = json.load(file)
-
-            # load manually entered data
-            insert_manual_csv_data(observations, manual_csv_file)
+            with profiler.stage("csv_merge"):
+                # load observations from json file
+                observations = []
+                json_problems = []
+                with open(observations_json_file, 'r') as file:
+                    observations = [Observation.from_json(data, json_problems) for data in json.load(file)]
+
+                # load manually entered data
+                coordinate_problems = insert_manual_csv_data(ObservationIndex(observations), manual_csv_file)
+
+                # bad RA/Dec in an older .auto.json count as well, unless the CSV has filled them in since
+                coordinate_problems += [problem for (obs, problem) in json_problems if obs.ra is None]
+
+            # catch typos in the CSV now rather than after a full render
+            if len(coordinate_problems) > 0:
+                print(f"{len(coordinate_problems)} visit(s) have RA/Dec that can't be used:")
+                for problem in coordinate_problems:
+                    print(f"  {problem}")
+                if not skip_bad_coordinates:
+                    print(f"Fix them in {manual_csv_file} (adding a row for any visit it does not list) or rerun with --skip-bad-coordinates to compile without their screenshots")
+                    exit(1)
 
             # throw out any observation that does not have a title
             # or have been manually excluded
-            observations = [obs for obs in observations if ("title" in obs and obs["title"] is not None and int(obs["VISIT ID"].split(":")[0]) not in exclusions)]
+            observations = [obs for obs in observations if (obs.title is not None and obs.proposal not in exclusions)]
 
             # create dir
             dir_name = datetime.datetime.now().strftime("%Y_%m_%d")
             os.makedirs(f"./output/{dir_name}/screenshots/")
+            profile_report_file = f"./output/{dir_name}/profile.json"
 
+            with profiler.stage("screenshot_cache"):
+                assign_screenshots(observations, f"./output/{dir_name}")
 
             output_ssc_file = os.path.abspath(f"./output/{dir_name}/screenshot_script.ssc")
-            script = make_stellarium_script(observations)
-            with open(output_ssc_file, 'w') as file:
-                file.write(script)
+            with profiler.stage("ssc_generation"):
+                script = make_stellarium_script(observations)
+                with open(output_ssc_file, 'w') as file:
+                    file.write(script)
 
             output_metadata_file = f"./output/{dir_name}/metadata.json"
-            metadata = make_metadata_dict(observations)
-            with open(output_metadata_file, 'w') as file:
-                json.dump(metadata, file, ensure_ascii = True, indent = 2)
+            with profiler.stage("metadata"):
+                metadata = make_metadata_dict(observations)
+                with open(output_metadata_file, 'w') as file:
+                    json.dump(metadata, file, ensure_ascii = True, indent = 2)
 
             output_chosts_file = f"./output/{dir_name}/chosts.json"
-            chosts = make_chosts(metadata)
-            with open(output_chosts_file, 'w') as file:
-                json.dump(chosts, file, ensure_ascii = True, indent = 2)
-
-            subprocess.run([
-                stellarium_exe,
-                "--screenshot-dir", os.path.abspath(f"./output/{dir_name}/screenshots/"),
-                "--full-screen", "yes",
-                "--fov", "40",
-                "--projection-type", "ProjectionFisheye",
-                "--startup-script", output_ssc_file,
-            ])
+            with profiler.stage("chosts"):
+                chosts = make_chosts(metadata)
+                with open(output_chosts_file, 'w') as file:
+                    json.dump(chosts, file, ensure_ascii = True, indent = 2)
+                jwst_chost_bundle.write_bundle(f"./output/{dir_name}/chosts.bundle", chosts)
+
+            with profiler.stage(screenshot_renderer):
+                if screenshot_renderer == "builtin":
+                    render_screenshots_builtin(observations, f"./output/{dir_name}")
+                else:
+                    render_screenshots(observations, f"./output/{dir_name}")
+
+            with profiler.stage("postprocess"):
+                postprocess_screenshots(f"./output/{dir_name}")
 
         case _:
             show_help()
 
+    if profiler.enabled and profile_report_file is not None:
+        profiler.write_report(profile_report_file, command)
+
     end_time = datetime.datetime.now()
     duration = (end_time - start_time).total_seconds()
     print(f"\nFinished after {duration} seconds\n")
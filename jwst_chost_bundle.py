@@ -0,0 +1,87 @@
+import os
+import json
+import zlib
+
+# chosts.bundle holds the same chosts as chosts.json, laid out so the poster can read the schedule without
+# loading every post:
+#
+#   JWSTCHOSTS 1\n
+#   index\n          a JSON list of [post time, visit id, offset, length, crc32] per chost, sorted by post time,
+#                    with the offsets counted from the end of the index line
+#   records          every chost as compact UTF-8 JSON without its post time, back to back
+
+bundle_magic = b"JWSTCHOSTS 1\n"
+
+def chost_record(chost):
+    # the post time lives in the index, so moving a post doesn't change its record (or crc)
+    return json.dumps({k: v for (k, v) in chost.items() if k != "post_time"}, ensure_ascii = False, separators = (",", ":")).encode("utf-8")
+
+def chost_name(chost):
+    # chosts.json from before visit ids were written fall back to the title
+    return chost.get("visit_id", chost["title"])
+
+def write_bundle(path, chosts):
+    index = []
+    records = []
+    offset = 0
+    # the post times are "%Y-%m-%d %H:%M:%S UTC", so they sort like the times they stand for
+    for chost in sorted(chosts, key = lambda chost: chost["post_time"]):
+        record = chost_record(chost)
+        index.append([chost["post_time"], chost_name(chost), offset, len(record), zlib.crc32(record)])
+        records.append(record)
+        offset += len(record)
+
+    tmp_path = path + ".part"
+    with open(tmp_path, 'wb') as file:
+        file.write(bundle_magic)
+        file.write(json.dumps(index, ensure_ascii = True, separators = (",", ":")).encode("ascii") + b"\n")
+        for record in records:
+            file.write(record)
+    os.replace(tmp_path, path)
+
+class BundleEntry:
+    # One chost of a bundle. Only the index data is kept, the chost itself is read when `load` is called.
+    def __init__(self, bundle, post_time, name, offset, length, crc, chost = None):
+        self.bundle = bundle
+        self.post_time = post_time
+        self.name = name
+        self.offset = offset
+        self.length = length
+        self.crc = crc
+        self.chost = chost
+
+    def load(self):
+        if self.chost is not None:
+            return dict(self.chost)
+        return self.bundle.read(self)
+
+class ChostBundle:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            if file.readline() != bundle_magic:
+                raise ValueError(f"{path} isn't a chost bundle")
+            index = json.loads(file.readline())
+            self.records_start = file.tell()
+
+        self.entries = [BundleEntry(self, *row) for row in index]
+
+    def read(self, entry):
+        with open(self.path, 'rb') as file:
+            file.seek(self.records_start + entry.offset)
+            record = file.read(entry.length)
+
+        if len(record) != entry.length or zlib.crc32(record) != entry.crc:
+            raise ValueError(f"the record of {entry.name} in {self.path} is damaged or the bundle was replaced")
+
+        chost = json.loads(record)
+        chost["post_time"] = entry.post_time
+        return chost
+
+def entries_from_chosts(chosts):
+    # the same entries for a plain chosts.json, which is already in memory anyway
+    entries = []
+    for chost in chosts:
+        record = chost_record(chost)
+        entries.append(BundleEntry(None, chost["post_time"], chost_name(chost), 0, len(record), zlib.crc32(record), chost))
+    return entries
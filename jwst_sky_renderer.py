@@ -0,0 +1,229 @@
+import os
+import csv
+import json
+import math
+import zlib
+import struct
+import tempfile
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+# A Stellarium-free stand-in for the compile screenshots: a fisheye sky chart around the target with
+# the bright stars, constellation lines, the azimuthal grid and the same red cross marker, as seen
+# from `latitude`/`longitude` at the scheduled start time with the zenith up.
+
+data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+image_width = 1280
+image_height = 720
+
+# Stellarium's default location
+latitude = 48.8534
+longitude = 2.3488
+
+background_color = (0, 0, 0)
+star_color = (255, 255, 255)
+constellation_color = (51, 51, 153)
+grid_color = (77, 51, 26)
+marker_color = (0xff, 0x33, 0x66)
+marker_size = 15
+
+grid_step = 10
+
+sky = None
+
+class SkyData:
+    # The catalog as unit vectors (J2000 equatorial), loaded once per process
+    def __init__(self):
+        ids = []
+        ra = []
+        dec = []
+        mags = []
+        with open(os.path.join(data_dir, "stars.csv"), 'r') as file:
+            for row in csv.DictReader(file):
+                ids.append(row["id"])
+                ra.append(float(row["ra_deg"]))
+                dec.append(float(row["dec_deg"]))
+                mags.append(float(row["mag"]))
+
+        self.stars = equatorial_vectors(np.array(ra), np.array(dec))
+        self.mags = np.array(mags)
+
+        with open(os.path.join(data_dir, "constellation_lines.json"), 'r') as file:
+            lines = json.load(file)
+        star_index = {star_id: i for (i, star_id) in enumerate(ids)}
+        pairs = np.array([(star_index[a], star_index[b]) for segments in lines.values() for (a, b) in segments])
+        self.line_starts = self.stars[pairs[:, 0]]
+        self.line_ends = self.stars[pairs[:, 1]]
+
+        (self.grid_starts, self.grid_ends) = azimuthal_grid()
+
+def load_sky():
+    global sky
+    if sky is None:
+        sky = SkyData()
+    return sky
+
+def equatorial_vectors(ra_deg, dec_deg):
+    ra = np.radians(ra_deg)
+    dec = np.radians(dec_deg)
+    return np.stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)], axis = -1)
+
+def horizontal_vectors(alt_deg, az_deg):
+    # (north, east, zenith) components, azimuth counted from north through east
+    alt = np.radians(alt_deg)
+    az = np.radians(az_deg)
+    return np.stack([np.cos(alt) * np.cos(az), np.cos(alt) * np.sin(az), np.sin(alt)], axis = -1)
+
+def azimuthal_grid():
+    # circles of constant altitude (including the horizon) and lines of constant azimuth, as 1° segments
+    steps = np.arange(0, 360, 1.0)
+    starts = []
+    ends = []
+    for alt in range(0, 90, grid_step):
+        starts.append(horizontal_vectors(np.full_like(steps, alt), steps))
+        ends.append(horizontal_vectors(np.full_like(steps, alt), steps + 1))
+    alts = np.arange(-90, 89, 1.0)
+    for az in range(0, 360, grid_step):
+        starts.append(horizontal_vectors(alts, np.full_like(alts, az)))
+        ends.append(horizontal_vectors(alts + 1, np.full_like(alts, az)))
+    return (np.concatenate(starts), np.concatenate(ends))
+
+def sidereal_degrees(timestamp):
+    # local mean sidereal time
+    days = timestamp / 86400 + 2440587.5 - 2451545.0
+    return (280.46061837 + 360.98564736629 * days + longitude) % 360
+
+def horizontal_rotation(timestamp):
+    # rotates J2000 equatorial unit vectors into (north, east, zenith), ignoring precession and refraction
+    lst = math.radians(sidereal_degrees(timestamp))
+    lat = math.radians(latitude)
+    return np.array([
+        [-math.sin(lat) * math.cos(lst), -math.sin(lat) * math.sin(lst), math.cos(lat)],
+        [-math.sin(lst), math.cos(lst), 0],
+        [math.cos(lat) * math.cos(lst), math.cos(lat) * math.sin(lst), math.sin(lat)],
+    ])
+
+class FisheyeView:
+    # equidistant fisheye around `center` (horizontal frame) with the zenith up
+    def __init__(self, center, fov):
+        self.center = center
+        up = np.array([0.0, 0.0, 1.0]) - center[2] * center
+        if np.linalg.norm(up) < 1e-9:
+            # looking straight up or down, put north up instead
+            up = np.array([1.0, 0.0, 0.0]) - center[0] * center
+        self.up = up / np.linalg.norm(up)
+        self.right = np.cross(self.up, center)
+        self.scale = (image_height / 2) / math.radians(fov / 2)
+        # angle from the center to the image corners
+        self.radius = math.hypot(image_width, image_height) / 2 / self.scale
+
+    def project(self, vectors):
+        # pixel coordinates and whether they are on the image
+        angle = np.arccos(np.clip(vectors @ self.center, -1, 1))
+        direction = np.arctan2(vectors @ self.up, vectors @ self.right)
+        radius = angle * self.scale
+        x = image_width / 2 + radius * np.cos(direction)
+        y = image_height / 2 - radius * np.sin(direction)
+        visible = (angle < math.radians(170)) & (x >= 0) & (x < image_width) & (y >= 0) & (y < image_height)
+        return (x, y, visible)
+
+def draw_points(image, x, y, visible, color):
+    image[y[visible].astype(np.intp), x[visible].astype(np.intp)] = color
+
+def draw_segments(image, view, starts, ends, color):
+    # samples every segment about once per pixel along the great circle between its ends
+    angles = np.arccos(np.clip(np.sum(starts * ends, axis = 1), -1, 1))
+
+    # skip segments that can't reach the image
+    start_angles = np.arccos(np.clip(starts @ view.center, -1, 1))
+    near = start_angles < view.radius + angles
+    (starts, ends, angles) = (starts[near], ends[near], angles[near])
+    if len(starts) == 0:
+        return
+
+    counts = np.clip(np.ceil(angles * view.scale), 2, 4 * image_width).astype(np.intp)
+    segment = np.repeat(np.arange(len(starts)), counts)
+    t = (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)) / np.repeat(counts - 1, counts)
+    points = starts[segment] * (1 - t)[:, None] + ends[segment] * t[:, None]
+    points /= np.linalg.norm(points, axis = 1)[:, None]
+
+    (x, y, visible) = view.project(points)
+    draw_points(image, x, y, visible, color)
+    # two pixels wide
+    draw_points(image, x + 1, y, visible & (x + 1 < image_width), color)
+
+def draw_stars(image, view, stars, mags):
+    (x, y, visible) = view.project(stars)
+    radii = np.clip(np.round(3.5 - 0.6 * mags), 1, 5).astype(np.intp)
+    brightness = np.clip(1.2 - 0.15 * mags, 0.35, 1.0)
+    for radius in np.unique(radii[visible]):
+        selected = visible & (radii == radius)
+        (dy, dx) = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+        inside = dx * dx + dy * dy <= radius * radius
+        px = (x[selected, None] + dx[inside][None, :]).astype(np.intp).ravel()
+        py = (y[selected, None] + dy[inside][None, :]).astype(np.intp).ravel()
+        colors = np.repeat(brightness[selected], inside.sum())[:, None] * np.array(star_color)
+        on_image = (px >= 0) & (px < image_width) & (py >= 0) & (py < image_height)
+        image[py[on_image], px[on_image]] = np.maximum(image[py[on_image], px[on_image]], colors[on_image].astype(np.uint8))
+
+def draw_marker(image):
+    cx = image_width // 2
+    cy = image_height // 2
+    image[cy - 1:cy + 1, cx - marker_size:cx + marker_size + 1] = marker_color
+    image[cy - marker_size:cy + marker_size + 1, cx - 1:cx + 1] = marker_color
+
+def render(ra_deg, dec_deg, timestamp, fov):
+    data = load_sky()
+    rotation = horizontal_rotation(timestamp)
+    target = rotation @ equatorial_vectors(ra_deg, dec_deg)
+    view = FisheyeView(target, fov)
+
+    image = np.zeros((image_height, image_width, 3), dtype = np.uint8)
+    if background_color != (0, 0, 0):
+        image[:] = background_color
+    draw_segments(image, view, data.grid_starts, data.grid_ends, grid_color)
+    draw_segments(image, view, data.line_starts @ rotation.T, data.line_ends @ rotation.T, constellation_color)
+    draw_stars(image, view, data.stars @ rotation.T, data.mags)
+    draw_marker(image)
+    return image
+
+def png_chunk(tag, data):
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+def write_png(path, image):
+    (height, width, _) = image.shape
+    # every scanline starts with filter type 0 (none)
+    raw = np.zeros((height, width * 3 + 1), dtype = np.uint8)
+    raw[:, 1:] = image.reshape(height, width * 3)
+
+    png = b"\x89PNG\r\n\x1a\n"
+    png += png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+    png += png_chunk(b"IDAT", zlib.compress(raw.tobytes(), 3))
+    png += png_chunk(b"IEND", b"")
+
+    (fd, tmp_path) = tempfile.mkstemp(suffix = ".part", dir = os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as file:
+        file.write(png)
+    os.replace(tmp_path, path)
+
+def render_job(job):
+    (path, ra_deg, dec_deg, timestamp, fov) = job
+    write_png(path, render(ra_deg, dec_deg, timestamp, fov))
+    return path
+
+def init_worker():
+    # workers forked from a parent running with tracemalloc (the parser's --profile) would trace every allocation too
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+    load_sky()
+
+def render_many(jobs, workers = None):
+    # jobs are (png path, RA in degrees, Dec in degrees, unix timestamp, fov in degrees)
+    workers = workers or os.cpu_count()
+    if workers == 1 or len(jobs) < 2:
+        return [render_job(job) for job in jobs]
+
+    with ProcessPoolExecutor(max_workers = workers, initializer = init_worker) as pool:
+        return list(pool.map(render_job, jobs, chunksize = max(1, len(jobs) // (workers * 4))))